@@ -0,0 +1,491 @@
+"""Нагрузочный стенд СказкоБота без обращения к Yandex Cloud и Telegram
+
+Поднимает локальные заглушки YandexGPT, SpeechKit и Telegram Bot API
+с настраиваемыми задержками, долей ошибок и размером ответов, прогоняет
+через FairyTaleBot заданное число пользователей по всему диалогу
+(/start → возраст → ... → выбор голоса) и выводит пропускную способность,
+квантили этапов, рост памяти и число потоков.
+
+Пример:
+    python bench.py --users 200 --concurrency 20 --save baseline.json
+    python bench.py --users 200 --concurrency 20 --compare baseline.json
+    python bench.py --dialog 100000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORDS = (
+    "жил был маленький ёжик который очень любил гулять по лесу однажды он встретил "
+    "доброго медвежонка и они вместе отправились искать волшебную звезду"
+).split()
+
+
+def percentiles(values) -> dict:
+    """p50/p95/p99 списка значений"""
+    values = sorted(values)
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    return {f"p{int(q * 100)}": values[min(int(len(values) * q), len(values) - 1)] for q in (0.5, 0.95, 0.99)}
+
+
+def rss_mb() -> float:
+    """Резидентная память процесса, МБ"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Upstream:
+    """Поведение заглушки: логнормальная задержка и доля ошибок"""
+
+    def __init__(self, latency: float, sigma: float, errors: float):
+        self.latency = latency
+        self.sigma = sigma
+        self.errors = errors
+        self.requests = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        return random.lognormvariate(0, self.sigma) * self.latency if self.latency > 0 else 0.0
+
+    def fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            failed = random.random() < self.errors
+            self.failed += failed
+        return failed
+
+
+class Stubs:
+    """Заглушки YandexGPT, SpeechKit и Telegram Bot API на локальных портах"""
+
+    def __init__(self, args):
+        self.gpt = Upstream(args.gpt_latency, args.latency_sigma, args.gpt_errors)
+        self.tts = Upstream(args.tts_latency, args.latency_sigma, args.tts_errors)
+        self.telegram = Upstream(args.tg_latency, args.latency_sigma, 0.0)
+        self.tale_chars = args.tale_chars
+        self.audio_bytes_per_char = args.audio_bytes_per_char
+
+        self._message_id = 0
+        self._events = {}  # chat_id -> список (метод, текст)
+        self._cond = threading.Condition()
+        self._servers = []
+
+    def start(self) -> dict:
+        """Запуск серверов, переменные окружения для бота"""
+        gpt = self._serve(self._gpt_handler())
+        tts = self._serve(self._tts_handler())
+        telegram = self._serve(self._telegram_handler())
+        return {
+            "YANDEX_GPT_URL": f"http://127.0.0.1:{gpt}/foundationModels/v1/completion",
+            "YANDEX_TTS_URL": f"http://127.0.0.1:{tts}/speech/v1/tts:synthesize",
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram}/bot",
+        }
+
+    def stop(self) -> None:
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+    def _serve(self, handler) -> int:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="bench-stub", daemon=True).start()
+        self._servers.append(server)
+        return server.server_address[1]
+
+    def _tale(self) -> str:
+        """Случайный текст нужной длины из абзацев и предложений"""
+        paragraphs, size = [], 0
+        while size < self.tale_chars:
+            sentences = [" ".join(random.choices(WORDS, k=random.randint(6, 14))).capitalize() + "."
+                         for _ in range(random.randint(3, 6))]
+            paragraphs.append(" ".join(sentences))
+            size += len(paragraphs[-1]) + 1
+        return "\n".join(paragraphs)[:self.tale_chars]
+
+    def _gpt_handler(self):
+        stubs = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                delay = stubs.gpt.delay()
+                if stubs.gpt.fail():
+                    time.sleep(delay / 2)
+                    return _reply(self, random.choice((429, 500, 503)), b'{"error": "stub"}')
+
+                text = stubs._tale()
+                usage = {"completionTokens": str(len(text) // 3)}
+                if not payload["completionOptions"].get("stream"):
+                    time.sleep(delay)
+                    body = {"result": {"alternatives": [{"message": {"text": text}}], "usage": usage}}
+                    return _reply(self, 200, json.dumps(body).encode())
+
+                # Поток: строки JSON с накопленным текстом
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                parts = 5
+                for i in range(1, parts + 1):
+                    time.sleep(delay / parts)
+                    chunk = text[:len(text) * i // parts]
+                    body = {"result": {"alternatives": [{"message": {"text": chunk}}], "usage": usage}}
+                    self.wfile.write(json.dumps(body).encode() + b"\n")
+                    self.wfile.flush()
+                self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _tts_handler(self):
+        stubs = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(stubs.tts.delay())
+                if stubs.tts.fail():
+                    return _reply(self, random.choice((429, 500, 503)), b'{"error": "stub"}')
+                return _reply(self, 200, os.urandom(len(body) * stubs.audio_bytes_per_char), 'audio/ogg')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _telegram_handler(self):
+        stubs = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('multipart/'):
+                    # Загрузка файла: нужен только chat_id
+                    found = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', raw)
+                    params = {'chat_id': int(found.group(1)) if found else 0}
+                else:
+                    params = json.loads(raw or b'{}')
+                time.sleep(stubs.telegram.delay())
+                stubs.telegram.fail()
+                _reply(self, 200, json.dumps({"ok": True, "result": stubs._result(method, params)}).encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _result(self, method: str, params: dict):
+        """Ответ Bot API и запись события для ожидающего пользователя"""
+        if method == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ('answerCallbackQuery', 'sendChatAction', 'deleteMessage', 'setWebhook'):
+            return True
+
+        chat_id = int(params.get('chat_id', 0))
+        with self._cond:
+            self._message_id += 1
+            message_id = self._message_id
+            self._events.setdefault(chat_id, []).append((method, params.get('text', '')))
+            self._cond.notify_all()
+
+        message = {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": params.get('text', '')
+        }
+        if method in ('sendAudio', 'sendVoice'):
+            kind = 'audio' if method == 'sendAudio' else 'voice'
+            message[kind] = {"file_id": f"{kind}-{message_id}", "file_unique_id": f"u{message_id}", "duration": 1}
+        return message
+
+    def mark(self, chat_id: int) -> int:
+        with self._cond:
+            return len(self._events.get(chat_id, []))
+
+    def wait(self, chat_id: int, since: int, marker: str = None, timeout: float = 120) -> bool:
+        """Ожидание сообщения бота в чате после события since (с текстом marker, если задан)"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                events = self._events.get(chat_id, [])[since:]
+                if any(marker is None or marker in text for _, text in events):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+
+def _reply(handler, status: int, body: bytes, content_type: str = 'application/json') -> None:
+    handler.send_response(status)
+    handler.send_header('Content-Type', content_type)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class Driver:
+    """Симуляция пользователей: обновления Telegram подаются прямо в очередь диспетчера"""
+
+    VOICES = ('male', 'female', 'cartoon', 'none')
+
+    def __init__(self, updater, stubs: Stubs, args):
+        self.updater = updater
+        self.stubs = stubs
+        self.args = args
+        self._update_id = 0
+        self._lock = threading.Lock()
+
+    def _push(self, data: dict) -> None:
+        from telegram import Update
+        with self._lock:
+            self._update_id += 1
+            data['update_id'] = self._update_id
+        self.updater.update_queue.put(Update.de_json(data, self.updater.bot))
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": "Bench"}
+
+    def _message(self, chat_id: int, text: str) -> None:
+        message = {
+            "message_id": random.randint(1, 10 ** 9), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "from": self._user(chat_id), "text": text
+        }
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        self._push({"message": message})
+
+    def _callback(self, chat_id: int, data: str) -> None:
+        self._push({"callback_query": {
+            "id": str(random.randint(1, 10 ** 9)), "from": self._user(chat_id), "chat_instance": str(chat_id),
+            "data": data, "message": {
+                "message_id": random.randint(1, 10 ** 9), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}
+            }
+        }})
+
+    def _step(self, chat_id: int, action, marker: str = None, timeout: float = 30) -> float:
+        """Действие пользователя и ожидание ответа бота; время ожидания, сек"""
+        if self.args.think > 0:
+            time.sleep(random.expovariate(1 / self.args.think))
+        since = self.stubs.mark(chat_id)
+        started = time.perf_counter()
+        action()
+        if not self.stubs.wait(chat_id, since, marker, timeout):
+            raise TimeoutError(marker or "нет ответа")
+        return time.perf_counter() - started
+
+    def run_user(self, chat_id: int) -> dict:
+        """Полный диалог одного пользователя"""
+        steps = {}
+        started = time.perf_counter()
+
+        def answer(field):
+            # Часть пользователей отвечает текстом, остальные пропускают шаг
+            if random.random() < self.args.answer_ratio:
+                return lambda: self._message(chat_id, f"{field} {random.choice(WORDS)}")
+            return lambda: self._callback(chat_id, f"skip_{field}")
+
+        steps['start'] = self._step(chat_id, lambda: self._message(chat_id, "/start"))
+        steps['creation'] = self._step(chat_id, lambda: self._callback(chat_id, "start_creation"))
+        steps['age'] = self._step(chat_id, lambda: self._callback(chat_id, f"age_{random.randint(2, 10)}"))
+        for field in ('name', 'family', 'pets', 'interests', 'situation'):
+            steps[field] = self._step(chat_id, answer(field))
+        steps['tale'] = self._step(chat_id, answer('request'), "Выберите вариант озвучки", self.args.timeout)
+        voice = random.choice(self.VOICES)
+        steps['voice'] = self._step(
+            chat_id, lambda: self._callback(chat_id, f"voice_{voice}"), "Чтобы создать новую", self.args.timeout
+        )
+        steps['total'] = time.perf_counter() - started
+        return steps
+
+
+def run(args) -> dict:
+    """Прогон стенда, итоговый отчёт"""
+    stubs = Stubs(args)
+    env = stubs.start()
+    os.environ.update(env)
+    for name, value in (("TELEGRAM_BOT_TOKEN", "123456:bench"), ("YANDEX_API_KEY", "bench"),
+                        ("YANDEX_FOLDER_ID", "bench"), ("YANDEX_SPEECH_API_KEY", "bench"),
+                        ("STATS_INTERVAL", "0")):
+        os.environ.setdefault(name, value)
+
+    # Адреса Yandex Cloud читаются при импорте, поэтому бот импортируется после настройки окружения
+    import skazki
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rss_before = rss_mb()
+    threads_before = threading.active_count()
+    bot = skazki.FairyTaleBot()
+    updater = skazki.create_updater(bot)
+    skazki.start_dispatcher(updater)
+
+    peak = {'threads': threads_before, 'rss': rss_before}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.1):
+            peak['threads'] = max(peak['threads'], threading.active_count())
+            peak['rss'] = max(peak['rss'], rss_mb())
+
+    threading.Thread(target=sample, name="bench-sampler", daemon=True).start()
+
+    driver = Driver(updater, stubs, args)
+    results, failures = [], {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency, thread_name_prefix="bench-user") as executor:
+        futures = [executor.submit(driver.run_user, 10 ** 6 + i) for i in range(args.users)]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failures[type(e).__name__] = failures.get(type(e).__name__, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    done.set()
+    rss_after = rss_mb()
+    threads_after = threading.active_count()
+    stages = bot.metrics.stages()
+    skazki.stop_dispatcher(updater)
+    bot.shutdown()
+    stubs.stop()
+
+    return {
+        'config': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+        'users': {'completed': len(results), 'failed': sum(failures.values()), 'errors': failures},
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else 0.0,
+        'user_steps': {step: percentiles([r[step] for r in results]) for step in (results[0] if results else {})},
+        'stages': stages,
+        'upstreams': {name: {'requests': u.requests, 'failed': u.failed}
+                      for name, u in (('gpt', stubs.gpt), ('tts', stubs.tts), ('telegram', stubs.telegram))},
+        'memory_mb': {'before': rss_before, 'peak': peak['rss'], 'after': rss_after,
+                      'growth': rss_after - rss_before},
+        'threads': {'before': threads_before, 'peak': peak['threads'], 'after': threads_after},
+    }
+
+
+def run_dialog(iterations: int) -> None:
+    """Прогон одного движка диалога без сети и Telegram: ответов в секунду"""
+    import skazki
+    engine = skazki.DialogEngine(skazki.FairyTaleBot.DIALOG)
+    session = skazki.Session(1)
+    answers = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        step = engine.first
+        while step is not None:
+            if step.choices:
+                step, value = engine.parse_callback(f"{step.field}_{step.choices[i % len(step.choices)][0]}")
+            else:
+                value = None if i % 2 else "ответ"
+            step, _ = engine.answer(session, step, value)
+            answers += 1
+    elapsed = time.perf_counter() - started
+    print(f"Диалогов: {iterations}, ответов: {answers}, {answers / elapsed:.0f} ответов/с, "
+          f"{elapsed / answers * 1e6:.1f} мкс на ответ")
+
+
+def print_report(report: dict, baseline: dict = None) -> None:
+    """Вывод отчёта; при наличии эталона - с изменением относительно него"""
+
+    def diff(value, path):
+        if baseline is None:
+            return ""
+        base = baseline
+        for key in path:
+            base = base.get(key) if isinstance(base, dict) else None
+        if not isinstance(base, (int, float)) or not base:
+            return ""
+        return f" ({(value - base) / base * 100:+.0f}%)"
+
+    users = report['users']
+    print(f"Пользователей: {users['completed']} завершили, {users['failed']} с ошибкой {users['errors'] or ''}")
+    print(f"Время: {report['elapsed']:.1f} с, пропускная способность "
+          f"{report['throughput']:.2f} польз./с{diff(report['throughput'], ['throughput'])}")
+
+    print("\nОжидание ответа бота (мс):")
+    for step, q in report['user_steps'].items():
+        print(f"  {step:10} " + "  ".join(
+            f"{name} {value * 1000:7.0f}{diff(value, ['user_steps', step, name])}" for name, value in q.items()
+        ))
+
+    print("\nЭтапы бота (мс):")
+    for stage, q in report['stages'].items():
+        print(f"  {stage:48} n={q['count']:<6}" + "  ".join(
+            f"{name} {q[name] * 1000:7.0f}{diff(q[name], ['stages', stage, name])}" for name in ('p50', 'p95', 'p99')
+        ))
+
+    print("\nЗаглушки: " + ", ".join(
+        f"{name} {u['requests']} запросов ({u['failed']} ошибок)" for name, u in report['upstreams'].items()
+    ))
+    memory, threads = report['memory_mb'], report['threads']
+    print(f"Память: {memory['before']:.0f} → пик {memory['peak']:.0f} → {memory['after']:.0f} МБ "
+          f"(рост {memory['growth']:+.1f} МБ{diff(memory['growth'], ['memory_mb', 'growth'])})")
+    print(f"Потоки: {threads['before']} → пик {threads['peak']}{diff(threads['peak'], ['threads', 'peak'])}"
+          f" → {threads['after']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд СказкоБота с локальными заглушками")
+    parser.add_argument("--users", type=int, default=50, help="сколько пользователей прогнать")
+    parser.add_argument("--concurrency", type=int, default=10, help="сколько пользователей одновременно")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза пользователя между шагами, сек")
+    parser.add_argument("--answer-ratio", type=float, default=0.5, help="доля шагов, где пользователь пишет текст")
+    parser.add_argument("--timeout", type=float, default=180, help="предельное ожидание сказки и озвучки, сек")
+    parser.add_argument("--gpt-latency", type=float, default=2.0, help="медианная задержка YandexGPT, сек")
+    parser.add_argument("--gpt-errors", type=float, default=0.0, help="доля ответов YandexGPT с ошибкой")
+    parser.add_argument("--tts-latency", type=float, default=0.5, help="медианная задержка SpeechKit, сек")
+    parser.add_argument("--tts-errors", type=float, default=0.0, help="доля ответов SpeechKit с ошибкой")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="медианная задержка Bot API, сек")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="разброс логнормальной задержки")
+    parser.add_argument("--tale-chars", type=int, default=3000, help="длина сказки, символов")
+    parser.add_argument("--audio-bytes-per-char", type=int, default=40, help="байт аудио на байт текста")
+    parser.add_argument("--dialog", type=int, default=0, help="только прогнать движок диалога столько раз")
+    parser.add_argument("--seed", type=int, default=None, help="зерно генератора случайных чисел")
+    parser.add_argument("--save", help="сохранить отчёт как эталон в JSON")
+    parser.add_argument("--compare", help="сравнить с эталоном из JSON")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.dialog:
+        run_dialog(args.dialog)
+        return 0
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    report = run(args)
+    print_report(report, baseline)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"\nЭталон сохранён в {args.save}")
+
+    return 0 if report['users']['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,39 @@
 import requests
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import json
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Updater, CommandHandler, CallbackContext,
-    MessageHandler, Filters, CallbackQueryHandler
+    MessageHandler, Filters, CallbackQueryHandler, DispatcherHandlerStop
 )
 import os
 from dotenv import load_dotenv
 from enum import Enum, auto
 import tempfile
+import threading
+import time
+import re
+import hashlib
+import shutil
+import sqlite3
+import subprocess
+import wave
+import random
+import asyncio
+import hmac
+import signal
+import multiprocessing
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -31,31 +56,1845 @@ class ConversationState(Enum):
     INTERESTS = auto()
     SITUATION = auto()
     REQUEST = auto()
+    GENERATING = auto()
     VOICE_SELECTION = auto()
 
 
+class Metrics:
+    """Счётчики, времена этапов и датчики в формате Prometheus
+
+    Времена хранятся окном последних значений, по которому считаются
+    квантили p50/p95/p99. В выключенном состоянии методы сразу возвращаются.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+    PREFIX = "skazki_"
+
+    def __init__(self, enabled: bool = True, window: int = 1024):
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = {}  # (имя, метки) -> значение
+        self._timings = {}  # (имя, метки) -> [окно значений, количество, сумма]
+        self._in_flight = {}  # (имя, метки) -> число выполняющихся
+        self._gauges = []  # (имя, метки, функция, тип)
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        """Увеличение счётчика"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Добавление замера времени"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            entry = self._timings.get(key)
+            if entry is None:
+                entry = self._timings[key] = [deque(maxlen=self.window), 0, 0.0]
+            entry[0].append(value)
+            entry[1] += 1
+            entry[2] += value
+
+    def timer(self, stage: str, **labels):
+        """Контекстный менеджер замера этапа с учётом выполняющихся"""
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(stage, labels)
+
+    @contextmanager
+    def _timer(self, stage: str, labels: dict):
+        labels = dict(labels, stage=stage)
+        key = self._key('in_flight', labels)
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, **labels)
+            with self._lock:
+                self._in_flight[key] -= 1
+
+    def timed(self, stage: str, func, **labels):
+        """Обёртка функции с замером времени"""
+        if not self.enabled:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self._timer(stage, labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def gauge(self, name: str, func, **labels) -> None:
+        """Датчик, значение которого вычисляется при выводе"""
+        self._gauges.append((name, labels, func, "gauge"))
+
+    def counter(self, name: str, func, **labels) -> None:
+        """Счётчик, накопленное с запуска значение которого вычисляется при выводе"""
+        self._gauges.append((name, labels, func, "counter"))
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        pairs = []
+        for name, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{name}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def _quantiles(self, values) -> list:
+        values = sorted(values)
+        if not values:
+            return [0.0 for _ in self.QUANTILES]
+        return [values[min(int(len(values) * q), len(values) - 1)] for q in self.QUANTILES]
+
+    def render(self) -> str:
+        """Текст метрик в формате Prometheus"""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {key: (list(v[0]), v[1], v[2]) for key, v in self._timings.items()}
+            in_flight = dict(self._in_flight)
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {self.PREFIX}{name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, "counter")
+            lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+
+        for (name, labels), (values, count, total) in sorted(timings.items()):
+            declare(name, "summary")
+            for q, value in zip(self.QUANTILES, self._quantiles(values)):
+                lines.append(f"{self.PREFIX}{name}{self._labels(labels + (('quantile', q),))} {value:.6f}")
+            lines.append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{self.PREFIX}{name}_count{self._labels(labels)} {count}")
+
+        for (name, labels), value in sorted(in_flight.items()):
+            declare(name, "gauge")
+            lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+
+        # Строки одной метрики должны идти подряд
+        for name, labels, func, kind in sorted(self._gauges, key=lambda gauge: gauge[0]):
+            try:
+                value = float(func())
+            except Exception as e:
+                logger.error(f"Ошибка датчика {name}: {str(e)}")
+                continue
+            declare(name, kind)
+            lines.append(f"{self.PREFIX}{name}{self._labels(tuple(sorted(labels.items())))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def stages(self) -> dict:
+        """Число замеров и квантили stage_seconds по каждому набору меток"""
+        with self._lock:
+            timings = {labels: (list(v[0]), v[1]) for (name, labels), v in self._timings.items()
+                       if name == 'stage_seconds'}
+
+        stages = {}
+        for labels, (values, count) in sorted(timings.items()):
+            p50, p95, p99 = self._quantiles(values)
+            stages[",".join(f"{k}={v}" for k, v in labels)] = {'count': count, 'p50': p50, 'p95': p95, 'p99': p99}
+        return stages
+
+    def summary(self) -> list:
+        """Строки для периодического вывода в лог"""
+        with self._lock:
+            timings = {key: (list(v[0]), v[1]) for key, v in self._timings.items()}
+            errors = {key: value for key, value in self._counters.items() if key[0] == 'errors_total'}
+
+        lines = []
+        for (_, labels), (values, count) in sorted(timings.items()):
+            p50, p95, p99 = self._quantiles(values)
+            name = ",".join(f"{k}={v}" for k, v in labels)
+            lines.append(
+                f"{name}: n={count} p50 {p50 * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс, p99 {p99 * 1000:.0f} мс"
+            )
+        if errors:
+            lines.append("ошибки: " + ", ".join(
+                f"{','.join(str(v) for _, v in labels)}={value}" for (_, labels), value in sorted(errors.items())
+            ))
+        return lines
+
+
+def start_metrics_server(metrics: Metrics, host: str, port: int) -> ThreadingHTTPServer:
+    """Локальный HTTP-сервер с метриками по адресу /metrics"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+
+class Session:
+    """Компактная запись диалога одного чата"""
+
+    __slots__ = ('chat_id', '_state', 'answers', 'fairy_tale', 'touched', 'last_voice', 'tales')
+
+    def __init__(self, chat_id: int, state: int = ConversationState.START.value,
+                 answers: dict = None, fairy_tale: str = None, touched: float = None,
+                 last_voice: str = None, tales: int = 0):
+        self.chat_id = chat_id
+        self._state = state
+        self.answers = answers if answers is not None else {}
+        self.fairy_tale = fairy_tale
+        self.touched = touched if touched is not None else time.time()
+        self.last_voice = last_voice
+        self.tales = tales
+
+    @property
+    def state(self) -> ConversationState:
+        return ConversationState(self._state)
+
+    @state.setter
+    def state(self, value: ConversationState) -> None:
+        self._state = value.value
+
+
+class MemorySessionStore:
+    """Хранилище сессий в памяти с удалением неактивных по TTL"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, chat_id: int):
+        """Сессия чата или None, если её нет или она истекла"""
+        with self._lock:
+            session = self._sessions.get(chat_id)
+        if session is not None and time.time() - session.touched > self.ttl:
+            return None
+        return session
+
+    def create(self, chat_id: int) -> Session:
+        """Новая сессия вместо прежней"""
+        session = Session(chat_id)
+        with self._lock:
+            self._sessions[chat_id] = session
+        self._mark_dirty(session)
+        return session
+
+    def save(self, session: Session) -> None:
+        """Отметка об изменении сессии; сессия, заменённая через /start, не сохраняется"""
+        with self._lock:
+            current = self._sessions.setdefault(session.chat_id, session)
+        # Задание пула могло держать прежнюю сессию - её запись затёрла бы новую
+        if current is not session:
+            return
+        session.touched = time.time()
+        self._mark_dirty(session)
+
+    def _mark_dirty(self, session: Session) -> None:
+        pass
+
+    def expire(self) -> int:
+        """Удаление сессий, неактивных дольше TTL"""
+        deadline = time.time() - self.ttl
+        with self._lock:
+            expired = [chat_id for chat_id, session in self._sessions.items() if session.touched < deadline]
+            for chat_id in expired:
+                del self._sessions[chat_id]
+        return len(expired)
+
+    def close(self) -> None:
+        pass
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SqliteSessionStore(MemorySessionStore):
+    """Хранилище сессий в SQLite с отложенной пакетной записью
+
+    Изменённые сессии накапливаются в памяти и записываются фоновым
+    потоком раз в flush_interval секунд одной транзакцией. В памяти
+    держатся только недавно активные сессии, остальные читаются с диска.
+    """
+
+    def __init__(self, path: str, ttl: float, flush_interval: float = 1.0, cache_ttl: float = 3600):
+        super().__init__(ttl)
+        self.cache_ttl = min(cache_ttl, ttl)
+        self._dirty = {}
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER PRIMARY KEY, state INTEGER, answers TEXT, fairy_tale TEXT, touched REAL, "
+            "last_voice TEXT, tales INTEGER DEFAULT 0)"
+        )
+        # Базы, созданные до появления last_voice и tales
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(sessions)")]
+        if 'last_voice' not in columns:
+            self._db.execute("ALTER TABLE sessions ADD COLUMN last_voice TEXT")
+        if 'tales' not in columns:
+            self._db.execute("ALTER TABLE sessions ADD COLUMN tales INTEGER DEFAULT 0")
+        self._db.commit()
+
+        self._flush_interval = flush_interval
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="session-flush", daemon=True)
+        self._flusher.start()
+
+    def get(self, chat_id: int):
+        session = super().get(chat_id)
+        if session is not None:
+            return session
+
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT state, answers, fairy_tale, touched, last_voice, tales FROM sessions WHERE chat_id = ?",
+                (chat_id,)
+            ).fetchone()
+        if row is None or time.time() - row[3] > self.ttl:
+            return None
+
+        state, answers, fairy_tale, touched, last_voice, tales = row
+        # Задание генерации не переживает перезапуск - даём отправить пожелание заново
+        if state == ConversationState.GENERATING.value:
+            state = ConversationState.REQUEST.value
+        session = Session(chat_id, state, json.loads(answers), fairy_tale, touched, last_voice, tales or 0)
+        with self._lock:
+            session = self._sessions.setdefault(chat_id, session)
+        return session
+
+    def _mark_dirty(self, session: Session) -> None:
+        with self._lock:
+            self._dirty[session.chat_id] = session
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        """Запись накопленных изменений одной транзакцией"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            rows = [
+                (s.chat_id, s._state, json.dumps(s.answers, ensure_ascii=False), s.fairy_tale, s.touched,
+                 s.last_voice, s.tales)
+                for s in dirty.values()
+            ]
+        if not rows:
+            return
+
+        try:
+            with self._db_lock, self._db:
+                self._db.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи сессий: {str(e)}")
+            with self._lock:
+                for chat_id, session in dirty.items():
+                    self._dirty.setdefault(chat_id, session)
+
+    def expire(self) -> int:
+        """Вытеснение из памяти неактивных сессий и удаление истекших с диска"""
+        now = time.time()
+        with self._lock:
+            idle = [
+                chat_id for chat_id, session in self._sessions.items()
+                if session.touched < now - self.cache_ttl and chat_id not in self._dirty
+            ]
+            for chat_id in idle:
+                del self._sessions[chat_id]
+
+        with self._db_lock, self._db:
+            removed = self._db.execute("DELETE FROM sessions WHERE touched < ?", (now - self.ttl,)).rowcount
+        return removed
+
+    def close(self) -> None:
+        """Остановка фоновой записи с сохранением оставшихся изменений"""
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        self._db.close()
+
+
+class MemoryBucketBackend:
+    """Состояние корзин token bucket в памяти процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # ключ -> [токены, время обновления]
+
+    def reserve(self, key: str, rate: float, capacity: float, amount: float) -> float:
+        """Списание amount токенов (допускается долг), возвращает время ожидания"""
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate) - amount
+            self._buckets[key] = (tokens, now)
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def level(self, key: str, rate: float, capacity: float) -> float:
+        """Текущее число токенов без списания"""
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - updated) * rate)
+
+    def cleanup(self, max_idle: float) -> None:
+        """Удаление давно не использовавшихся корзин"""
+        deadline = time.time() - max_idle
+        with self._lock:
+            for key in [k for k, (_, updated) in self._buckets.items() if updated < deadline]:
+                del self._buckets[key]
+
+
+class SqliteBucketBackend:
+    """Состояние корзин в файле SQLite, общее для нескольких процессов на одном хосте
+
+    Транзакция BEGIN IMMEDIATE берёт блокировку записи на файл, поэтому
+    списание атомарно между процессами.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+        )
+
+    def reserve(self, key: str, rate: float, capacity: float, amount: float) -> float:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                tokens = min(capacity, tokens + (now - updated) * rate) - amount
+                self._db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def level(self, key: str, rate: float, capacity: float) -> float:
+        with self._lock:
+            row = self._db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        tokens, updated = row if row else (capacity, time.time())
+        return min(capacity, tokens + (time.time() - updated) * rate)
+
+    def cleanup(self, max_idle: float) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM buckets WHERE updated < ?", (time.time() - max_idle,))
+
+
+class RateLimiter:
+    """Ограничение частоты обращений по алгоритму token bucket
+
+    Запрос сверх лимита не отклоняется: токены списываются в долг и
+    вызывающий ждёт, пока долг не погасится. Каждый следующий запрос
+    встаёт за предыдущими, так что очередь получается честной (FIFO)
+    и в пределах одного процесса, и между процессами с общим хранилищем.
+    """
+
+    def __init__(self, backend, limits: dict):
+        self.backend = backend
+        # имя -> (скорость пополнения в секунду, ёмкость); нулевая скорость - без ограничения
+        self.limits = {name: limit for name, limit in limits.items() if limit[0] > 0}
+        self._lock = threading.Lock()
+        self._waits = {}
+
+    def reserve(self, name: str, amount: float = 1, key=None) -> float:
+        """Резервирование amount единиц, возвращает время ожидания своей очереди"""
+        limit = self.limits.get(name)
+        if limit is None:
+            return 0.0
+        rate, capacity = limit
+        bucket = f"{name}:{key}" if key is not None else name
+        delay = self.backend.reserve(bucket, rate, capacity, amount)
+
+        with self._lock:
+            count, total = self._waits.get(name, (0, 0.0))
+            self._waits[name] = (count + (delay > 0), total + delay)
+        return delay
+
+    def acquire(self, *requests) -> float:
+        """Резервирование в нескольких корзинах сразу и ожидание очереди"""
+        delay = max((self.reserve(*request) for request in requests), default=0.0)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def headroom(self, name: str, key=None) -> float:
+        """Доля свободной ёмкости корзины: 1 - полная, 0 и меньше - в долгу"""
+        limit = self.limits.get(name)
+        if limit is None:
+            return 1.0
+        rate, capacity = limit
+        bucket = f"{name}:{key}" if key is not None else name
+        return self.backend.level(bucket, rate, capacity) / capacity
+
+    def cleanup(self, max_idle: float = 86400) -> None:
+        self.backend.cleanup(max_idle)
+
+    def stats(self) -> dict:
+        """Сколько раз и как долго ждали по каждому лимиту"""
+        with self._lock:
+            return {name: {'delayed': count, 'wait_total': total} for name, (count, total) in self._waits.items()}
+
+
+class Speculation:
+    """Упреждающая озвучка сказки, ожидающая выбора голоса"""
+
+    __slots__ = ('voice_type', 'text', 'created', 'started', 'done', 'cancelled', 'audio')
+
+    def __init__(self, voice_type: str, text: str):
+        self.voice_type = voice_type
+        self.text = text
+        self.created = time.monotonic()
+        self.started = False
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self.audio = None
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов
+
+    Пока вызов с данным ключом выполняется, повторные вызовы не
+    запускают его заново, а ждут и получают тот же результат или ошибку.
+    """
+
+    class _Call:
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class PromptBuilder:
+    """Промпт сказки в пределах бюджета токенов
+
+    Свободные ответы родителей сжимаются до бюджета своего поля по границе
+    предложения или слова, а длина сказки и maxTokens подбираются по
+    возрасту ребёнка. Токены оцениваются по длине текста: для русского
+    текста у YandexGPT выходит около трёх символов на токен.
+    """
+
+    CHARS_PER_TOKEN = 3
+    TOKENS_PER_WORD = 2.5
+    # Поле ответа, строка промпта, бюджет в токенах
+    FIELDS = (
+        ('name', "Главный герой", 10),
+        ('family', "Члены семьи", 60),
+        ('pets', "Питомцы", 40),
+        ('interests', "Интересы", 60),
+        ('situation', "Проблемная ситуация", 150),
+        ('request', "Желаемый посыл", 100),
+    )
+    # Возраст (включительно) -> длина сказки в словах
+    LENGTHS = ((3, 150, 250), (5, 250, 400), (7, 400, 550), (10, 500, 700))
+
+    def __init__(self, max_tokens: int = 2000):
+        self.max_tokens_limit = max_tokens
+        self.truncated = 0
+
+    @classmethod
+    def estimate_tokens(cls, text: str) -> int:
+        return -(-len(text) // cls.CHARS_PER_TOKEN)
+
+    def fit(self, text: str, tokens: int) -> str:
+        """Текст без лишних пробелов, сокращённый до tokens токенов"""
+        text = " ".join(text.split())
+        limit = tokens * self.CHARS_PER_TOKEN
+        if len(text) <= limit:
+            return text
+
+        self.truncated += 1
+        cut = text[:limit]
+        # Целое предложение, если оно занимает хотя бы половину бюджета, иначе целые слова
+        end = max(cut.rfind(mark) for mark in '.!?')
+        if end >= limit // 2:
+            return cut[:end + 1]
+        space = cut.rfind(' ')
+        return (cut[:space] if space > 0 else cut).rstrip(',;:- ') + "…"
+
+    def length(self, age) -> tuple:
+        """Длина сказки в словах (от, до) для возраста"""
+        try:
+            age = int(age)
+        except (TypeError, ValueError):
+            return self.LENGTHS[-1][1:]
+        for max_age, low, high in self.LENGTHS:
+            if age <= max_age:
+                return low, high
+        return self.LENGTHS[-1][1:]
+
+    def max_tokens(self, age) -> int:
+        """maxTokens с запасом на название, мораль и отклонение от заданной длины"""
+        _, high = self.length(age)
+        return min(self.max_tokens_limit, int(high * self.TOKENS_PER_WORD * 1.15) + 50)
+
+    def build(self, answers: dict) -> str:
+        """Промпт по ответам родителя"""
+        age = answers.get('age')
+        prompt = "Напиши детскую сказку со следующими параметрами:\n"
+        prompt += f"- Возраст ребёнка: {age or 'не указан'} лет\n"
+
+        for field, title, budget in self.FIELDS:
+            if answers.get(field):
+                prompt += f"- {title}: {self.fit(answers[field], budget)}\n"
+
+        low, high = self.length(age)
+        prompt += (
+            "\nТребования к сказке:\n"
+            "1. Простой язык по возрасту\n"
+            "2. Включи указанные персонажи\n"
+            "3. Ненавязчивый посыл\n"
+            "4. Увлекательный сюжет\n"
+            f"5. Длина {low}-{high} слов\n"
+            "6. Диалоги и описания\n"
+            "7. Мораль в конце\n"
+            "Формат:\nНазвание\n\nТекст...\n\nМораль: ..."
+        )
+        return prompt
+
+
+class TalePool:
+    """Запас заранее сгенерированных сказок для запросов без персонализации
+
+    Сказки хранятся по ключу (возраст, вид): 'age' - указан только возраст,
+    'name' - возраст и имя; во втором случае сказка пишется с меткой
+    NAME_MARKER, которая при выдаче заменяется именем ребёнка. Одну сказку
+    можно выдать не больше max_uses раз и никогда - дважды в один чат.
+    """
+
+    NAME_MARKER = "[ИМЯ]"
+    AGES = [str(age) for age in range(2, 11)]
+    PERSONAL_FIELDS = ('family', 'pets', 'interests', 'situation', 'request')
+
+    def __init__(self, depth: int, max_age: float, max_uses: int = 1, history: int = 50):
+        self.depth = depth
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.history = history
+        self._lock = threading.Lock()
+        self._entries = {}  # ключ -> [[id, текст, время создания, выдач]]
+        self._served = OrderedDict()  # chat_id -> id выданных сказок
+        self._next_id = 0
+        self._stats = {'served': 0, 'misses': 0, 'generated': 0, 'rejected': 0, 'expired': 0}
+
+    @classmethod
+    def key(cls, answers: dict):
+        """Ключ запаса для ответов или None, если сказка персонализирована"""
+        if answers.get('age') not in cls.AGES or any(answers.get(f) for f in cls.PERSONAL_FIELDS):
+            return None
+        return answers['age'], 'name' if answers.get('name') else 'age'
+
+    def _fresh(self, key) -> list:
+        entries = self._entries.setdefault(key, [])
+        deadline = time.time() - self.max_age
+        fresh = [entry for entry in entries if entry[2] >= deadline]
+        self._stats['expired'] += len(entries) - len(fresh)
+        self._entries[key] = fresh
+        return fresh
+
+    def take(self, answers: dict, chat_id: int):
+        """Готовая сказка для ответов или None"""
+        key = self.key(answers)
+        if key is None:
+            return None
+
+        with self._lock:
+            entries = self._fresh(key)
+            served = self._served.get(chat_id)
+            if served is None:
+                served = self._served[chat_id] = deque(maxlen=self.history)
+                if len(self._served) > 10000:
+                    self._served.popitem(last=False)
+            self._served.move_to_end(chat_id)
+
+            for entry in entries:
+                if entry[0] not in served:
+                    break
+            else:
+                self._stats['misses'] += 1
+                return None
+
+            entry[3] += 1
+            if entry[3] >= self.max_uses:
+                entries.remove(entry)
+            served.append(entry[0])
+            self._stats['served'] += 1
+            text = entry[1]
+
+        if key[1] == 'name':
+            text = text.replace(self.NAME_MARKER, answers['name'])
+        return text
+
+    def put(self, key, text: str) -> bool:
+        """Добавление сказки; сказка с именем без метки или со склонённой меткой отбрасывается"""
+        if key[1] == 'name':
+            marker = re.escape(self.NAME_MARKER)
+            if self.NAME_MARKER not in text or re.search(marker + r'\w', text):
+                with self._lock:
+                    self._stats['rejected'] += 1
+                return False
+
+        with self._lock:
+            self._next_id += 1
+            self._entries.setdefault(key, []).append([self._next_id, text, time.time(), 0])
+            self._stats['generated'] += 1
+        return True
+
+    def wanted(self):
+        """Ключ с наименьшим запасом ниже depth или None"""
+        with self._lock:
+            counts = {(age, kind): len(self._fresh((age, kind))) for age in self.AGES for kind in ('age', 'name')}
+        key = min(counts, key=counts.get)
+        return key if counts[key] < self.depth else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = sum(len(entries) for entries in self._entries.values())
+        return stats
+
+
+class PoolJob:
+    """Задание пула генерации"""
+
+    __slots__ = ('func', 'args', 'enqueued', 'deadline', 'on_shed', 'on_wait', 'notified', 'journal')
+
+    def __init__(self, func, args: tuple, max_wait: float = 0, on_shed=None, on_wait=None, journal: dict = None):
+        self.func = func
+        self.args = args
+        self.enqueued = time.monotonic()
+        self.deadline = self.enqueued + max_wait if max_wait > 0 else None
+        self.on_shed = on_shed
+        self.on_wait = on_wait
+        self.notified = False
+        self.journal = journal
+
+
+class WorkerPool:
+    """Ограниченный пул потоков для заданий генерации
+
+    Задания выбираются по классу приоритета (меньше - важнее), внутри
+    класса - по кругу между чатами, причём у чата выполняется не больше
+    одного задания одновременно. Задание, прождавшее в очереди дольше
+    max_wait, отбрасывается: пользователь, скорее всего, уже ушёл.
+
+    При остановке новые задания не запускаются, выполняющиеся получают
+    время на завершение, а описания journal незавершённых возвращаются
+    вызывающему для сохранения в журнал.
+    """
+
+    FIRST_TALE = 0
+    VOICE = 1
+    REPEAT_TALE = 2
+    BACKGROUND = 3
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self._cond = threading.Condition()
+        self._classes = {}  # приоритет -> OrderedDict: чат -> deque заданий
+        self._busy = set()  # чаты с выполняющимся заданием
+        self._running = {}  # поток -> выполняющееся задание
+        self._unstarted = []  # задания, не начатые из-за остановки
+        self._depth = 0
+        self._stopping = False
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._shed = 0
+        self._waits = deque(maxlen=1000)
+        self._threads = []
+
+        for i in range(size):
+            thread = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, chat_id: int = None, priority: int = FIRST_TALE, max_wait: float = 0,
+               on_shed=None, on_wait=None, journal: dict = None) -> int:
+        """Постановка задания в очередь, возвращает глубину очереди
+
+        on_shed() вызывается, если задание отброшено по max_wait,
+        on_wait(position) - однажды, если задание ждёт дольше порога notify_waiting,
+        journal - описание для возобновления задания после перезапуска.
+        """
+        # Задания без чата друг друга не ждут
+        key = chat_id if chat_id is not None else object()
+        job = PoolJob(func, args, max_wait, on_shed, on_wait, journal)
+        with self._cond:
+            if self._stopping:
+                self._unstarted.append(job)
+                return 0
+            self._classes.setdefault(priority, OrderedDict()).setdefault(key, deque()).append(job)
+            self._depth += 1
+            self._cond.notify()
+            return self._depth
+
+    def _take(self):
+        """Следующее задание (чат, задание) и отброшенные просроченные; вызывается под блокировкой"""
+        now = time.monotonic()
+        shed = []
+        for priority in sorted(self._classes):
+            chats = self._classes[priority]
+            for key in list(chats):
+                if key in self._busy:
+                    continue
+                jobs = chats.pop(key)
+                job = jobs.popleft()
+                self._depth -= 1
+                # Чат с оставшимися заданиями уходит в конец круга
+                if jobs:
+                    chats[key] = jobs
+                if job.deadline is not None and now > job.deadline:
+                    shed.append(job)
+                    continue
+                self._busy.add(key)
+                return key, job, shed
+        return None, None, shed
+
+    def _worker(self) -> None:
+        """Цикл рабочего потока"""
+        while True:
+            with self._cond:
+                while True:
+                    key, job, shed = self._take()
+                    if job is not None or shed:
+                        break
+                    if self._stopping and self._depth == 0:
+                        return
+                    self._cond.wait()
+                self._shed += len(shed)
+                if job is not None:
+                    self._waits.append(time.monotonic() - job.enqueued)
+                    self._in_flight += 1
+                    self._running[threading.current_thread()] = job
+
+            for expired in shed:
+                logger.warning(f"Задание пула {self.name} отброшено после {time.monotonic() - expired.enqueued:.0f} с ожидания")
+                if expired.on_shed is not None:
+                    try:
+                        expired.on_shed()
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки отброшенного задания в пуле {self.name}: {str(e)}")
+            if job is None:
+                continue
+
+            try:
+                job.func(*job.args)
+                with self._cond:
+                    self._completed += 1
+            except Exception as e:
+                logger.error(f"Ошибка задания в пуле {self.name}: {str(e)}")
+                with self._cond:
+                    self._failed += 1
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._busy.discard(key)
+                    del self._running[threading.current_thread()]
+                    self._cond.notify_all()
+
+    def notify_waiting(self, threshold: float) -> None:
+        """Сообщение позиции в очереди заданиям, которые ждут дольше threshold"""
+        now = time.monotonic()
+        due = []
+        with self._cond:
+            ahead = 0
+            for priority in sorted(self._classes):
+                chats = self._classes[priority]
+                for index, jobs in enumerate(chats.values()):
+                    for turn, job in enumerate(jobs):
+                        if job.on_wait is not None and not job.notified and now - job.enqueued >= threshold:
+                            job.notified = True
+                            due.append((job.on_wait, ahead + turn * len(chats) + index + 1))
+                ahead += sum(len(jobs) for jobs in chats.values())
+
+        for on_wait, position in due:
+            try:
+                on_wait(position)
+            except Exception as e:
+                logger.error(f"Ошибка уведомления об очереди в пуле {self.name}: {str(e)}")
+
+    def stats(self) -> dict:
+        """Глубина очереди и время ожидания заданий"""
+        with self._cond:
+            waits = sorted(self._waits)
+            result = {
+                'workers': self.size,
+                'depth': self._depth,
+                'in_flight': self._in_flight,
+                'completed': self._completed,
+                'failed': self._failed,
+                'shed': self._shed,
+            }
+
+        result['wait_avg'] = sum(waits) / len(waits) if waits else 0.0
+        result['wait_p95'] = waits[int(len(waits) * 0.95)] if waits else 0.0
+        result['wait_max'] = waits[-1] if waits else 0.0
+        return result
+
+    def shutdown(self, timeout: float = None) -> dict:
+        """Остановка: очередь снимается, выполняющиеся задания ждут не дольше timeout
+
+        Возвращает число завершённых за это время заданий, описания
+        незавершённых для журнала и число незавершённых без описания.
+        """
+        with self._cond:
+            self._stopping = True
+            completed = self._completed + self._failed
+            for chats in self._classes.values():
+                for jobs in chats.values():
+                    self._unstarted.extend(jobs)
+            self._classes.clear()
+            self._depth = 0
+            self._cond.notify_all()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+        with self._cond:
+            unfinished = self._unstarted + list(self._running.values())
+            self._unstarted = []
+            drained = self._completed + self._failed - completed
+        pending = [job.journal for job in unfinished if job.journal is not None]
+        return {'drained': drained, 'pending': pending, 'dropped': len(unfinished) - len(pending)}
+
+
+class StreamingMessage:
+    """Сообщение Telegram, которое дописывается по мере поступления текста"""
+
+    MAX_LENGTH = 4096
+
+    def __init__(self, bot, chat_id: int, interval: float):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self._messages = []  # [message_id, показанный текст]
+        self._pending = ""
+        self._next_edit = 0.0
+        self._failed = False
+
+    def update(self, text: str) -> None:
+        """Новый вариант текста; правки объединяются и ограничиваются по частоте"""
+        self._pending = text
+        # После ошибки Telegram промежуточные правки больше не отправляются
+        if self._failed:
+            return
+        # Первый фрагмент показываем сразу, дальше - не чаще одной правки за интервал
+        if self._messages and time.monotonic() < self._next_edit:
+            return
+        try:
+            self._flush()
+        except Exception as e:
+            # Ошибка показа не должна прерывать генерацию
+            logger.warning(f"Потоковый вывод в чат {self.chat_id} остановлен: {str(e)}")
+            self._failed = True
+
+    def finish(self, text: str) -> None:
+        """Итоговый текст, отправляется без ограничения частоты"""
+        self._pending = text
+        if self._failed:
+            # Состояние отправленных частей неизвестно - итог отправляется новыми сообщениями
+            self._messages = []
+        delay = self._next_edit - time.monotonic()
+        if self._messages and delay > 0:
+            time.sleep(delay)
+        self._flush()
+
+    def _flush(self) -> None:
+        """Синхронизация отправленных сообщений с накопленным текстом"""
+        parts = self._split(self._pending)
+        try:
+            for i, part in enumerate(parts):
+                if i >= len(self._messages):
+                    message = self.bot.send_message(chat_id=self.chat_id, text=part)
+                    self._messages.append([message.message_id, part])
+                elif self._messages[i][1] != part:
+                    self.bot.edit_message_text(
+                        text=part, chat_id=self.chat_id, message_id=self._messages[i][0]
+                    )
+                    self._messages[i][1] = part
+            self._next_edit = time.monotonic() + self.interval
+        except RetryAfter as e:
+            self._next_edit = time.monotonic() + e.retry_after
+        except BadRequest as e:
+            # Telegram отклоняет правку без изменений
+            if 'not modified' not in str(e):
+                raise
+
+    def _split(self, text: str) -> list:
+        """Разбиение текста на части по лимиту длины сообщения"""
+        parts = []
+        while len(text) > self.MAX_LENGTH:
+            cut = text.rfind('\n', 0, self.MAX_LENGTH)
+            if cut <= 0:
+                cut = self.MAX_LENGTH
+            parts.append(text[:cut])
+            text = text[cut:].lstrip('\n')
+        if text:
+            parts.append(text)
+        return parts
+
+
+class AudioEncoder:
+    """Выходной этап озвучки: части ответа SpeechKit -> файл для Telegram
+
+    oggopus: части склеиваются последовательностью Ogg-потоков, а при
+    заданном битрейте перекодируются ffmpeg в Opus этого битрейта.
+    lpcm: части склеиваются в один PCM-поток и кодируются ffmpeg в Opus,
+    без ffmpeg - упаковываются в WAV. Если ffmpeg не справился с oggopus,
+    файл отдаётся без перекодирования.
+    """
+
+    def __init__(self, tts_format: str, sample_rate: int, bitrate: str = "", timeout: float = 60):
+        self.tts_format = tts_format
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate
+        self.timeout = timeout
+        self.ffmpeg = shutil.which("ffmpeg") if bitrate or tts_format == 'lpcm' else None
+        if bitrate and not self.ffmpeg:
+            logger.warning("ffmpeg не найден, озвучка отправляется без перекодирования")
+        # Контейнер результата не зависит от конкретной сказки
+        self.container = 'wav' if tts_format == 'lpcm' and not self.ffmpeg else 'ogg'
+
+    def _command(self) -> list:
+        if self.tts_format == 'lpcm':
+            source = ["-f", "s16le", "-ar", str(self.sample_rate), "-ac", "1"]
+        else:
+            source = ["-f", "ogg"]
+        return [
+            self.ffmpeg, "-hide_banner", "-loglevel", "error", *source, "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", self.bitrate or "32k", "-application", "voip", "-f", "ogg", "pipe:1"
+        ]
+
+    def encode(self, parts: list, output) -> None:
+        """Запись готового файла в output"""
+        if self.ffmpeg:
+            try:
+                result = subprocess.run(
+                    self._command(), input=b"".join(parts),
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout, check=True
+                )
+                output.write(result.stdout)
+                return
+            except (OSError, subprocess.SubprocessError) as e:
+                # PCM вместо ожидаемого Ogg отправить нельзя
+                if self.tts_format == 'lpcm':
+                    raise
+                logger.error(f"Ошибка перекодирования озвучки, отправляется исходный файл: {str(e)}")
+
+        if self.tts_format == 'lpcm':
+            with wave.open(output, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(self.sample_rate)
+                for part in parts:
+                    wav.writeframes(part)
+        else:
+            # Последовательность Ogg-потоков - корректный Ogg-файл (chained stream)
+            for part in parts:
+                output.write(part)
+
+
+class AudioCache:
+    """Кэш озвучки: file_id Telegram и, при наличии каталога, файлы озвучки на диске"""
+
+    def __init__(self, directory: str = None, max_bytes: int = 0, max_entries: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._file_ids = OrderedDict()  # ключ -> (file_id, размер, вид: voice или audio)
+        self._files = OrderedDict()  # ключ -> размер файла на диске
+        self._disk_bytes = 0
+        self._lookups = 0
+        self._file_id_hits = 0
+        self._disk_hits = 0
+        self._bytes_saved = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # Восстанавливаем порядок LRU по времени последнего обращения
+            entries = []
+            for name in os.listdir(directory):
+                if name.endswith('.ogg'):
+                    stat = os.stat(os.path.join(directory, name))
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._files[key] = size
+                self._disk_bytes += size
+
+    @staticmethod
+    def key(text: str, voice: str, speed: str, audio_format: str) -> str:
+        """Ключ кэша по содержимому и параметрам синтеза"""
+        return hashlib.sha256(f"{voice}|{speed}|{audio_format}|{text}".encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.ogg")
+
+    def __contains__(self, key: str) -> bool:
+        """Есть ли аудио в кэше (без учёта в статистике)"""
+        with self._lock:
+            return key in self._file_ids or key in self._files
+
+    def get_file_id(self, key: str):
+        """(file_id, вид) ранее загруженного аудио или None"""
+        with self._lock:
+            self._lookups += 1
+            entry = self._file_ids.get(key)
+            if entry is None:
+                return None
+            self._file_ids.move_to_end(key)
+            self._file_id_hits += 1
+            self._bytes_saved += entry[1]
+            return entry[0], entry[2]
+
+    def put_file_id(self, key: str, file_id: str, size: int, kind: str = 'audio') -> None:
+        """Запоминание file_id после первой загрузки"""
+        with self._lock:
+            self._file_ids[key] = (file_id, size, kind)
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self.max_entries:
+                self._file_ids.popitem(last=False)
+
+    def get_path(self, key: str):
+        """Путь к сохранённому на диске аудио или None"""
+        with self._lock:
+            size = self._files.get(key)
+            if size is None:
+                return None
+            self._files.move_to_end(key)
+            self._disk_hits += 1
+            self._bytes_saved += size
+
+        path = self._path(key)
+        os.utime(path)
+        return path
+
+    def put_file(self, key: str, source) -> None:
+        """Копирование аудио из файлового объекта в дисковый кэш с вытеснением давно не используемых"""
+        if not self.directory:
+            return
+
+        temp_path = f"{self._path(key)}.tmp"
+        with open(temp_path, 'wb') as f:
+            shutil.copyfileobj(source, f)
+            size = f.tell()
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return
+        os.replace(temp_path, self._path(key))
+
+        evicted = []
+        with self._lock:
+            self._disk_bytes += size - self._files.pop(key, 0)
+            self._files[key] = size
+            while self._disk_bytes > self.max_bytes:
+                old_key, old_size = self._files.popitem(last=False)
+                self._disk_bytes -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        """Доля попаданий и сэкономленные байты"""
+        with self._lock:
+            hits = self._file_id_hits + self._disk_hits
+            return {
+                'lookups': self._lookups,
+                'file_id_hits': self._file_id_hits,
+                'disk_hits': self._disk_hits,
+                'hit_ratio': hits / self._lookups if self._lookups else 0.0,
+                'bytes_saved': self._bytes_saved,
+                'disk_bytes': self._disk_bytes,
+            }
+
+
+# Замеры установки соединения для текущего потока
+_http_timing = threading.local()
+
+
+class _TimedConnectionMixin:
+    """Замер времени TCP-соединения (вместе с DNS) и TLS-рукопожатия"""
+
+    def _new_conn(self):
+        started = time.perf_counter()
+        sock = super()._new_conn()
+        _http_timing.connect = time.perf_counter() - started
+        return sock
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _http_timing.tls = max(time.perf_counter() - started - _http_timing.connect, 0.0)
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """Адаптер requests, соединения которого замеряют время установки"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+class CircuitOpenError(Exception):
+    """Сервис временно недоступен, запрос отклонён без обращения к нему"""
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для одного сервиса
+
+    После failure_threshold ошибок подряд запросы отклоняются сразу,
+    через reset_timeout секунд пропускается один пробный запрос.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_abort(self) -> None:
+        """Пробный запрос прерван без ответа сервиса: размыкатель снова разомкнут до следующей пробы"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    logger.warning(f"Размыкатель разомкнут после {self._failures} ошибок подряд")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class YandexClient:
+    """HTTP-клиент сервиса Yandex Cloud с пулом keep-alive соединений
+
+    Запросы повторяются при 429/5xx и сетевых ошибках с экспоненциальной
+    задержкой со случайным разбросом (или по Retry-After), но не дольше
+    общего срока deadline. Медленный запрос без потокового ответа может
+    дублироваться через hedge_after секунд - используется первый ответ.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, name: str, url: str, headers: dict, pool_size: int,
+                 connect_timeout: float, read_timeout: float, deadline: float,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 hedge_after: float = 0.0, breaker: CircuitBreaker = None):
+        self.name = name
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker(5, 30)
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._hedge_executor = (
+            ThreadPoolExecutor(max_workers=pool_size * 2, thread_name_prefix=f"{name}-hedge")
+            if hedge_after > 0 else None
+        )
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._new_connections = 0
+        self._retries = 0
+        self._hedges = 0
+        self._failures = {}
+        self._timings = deque(maxlen=1000)
+
+    def post(self, deadline: float = None, **kwargs) -> requests.Response:
+        """POST-запрос к сервису с повторами; замеры доступны в response.timing
+
+        deadline - момент time.monotonic(), после которого повторы прекращаются.
+        Ответ с ошибкой, которую не удалось исправить повтором, возвращается
+        как есть, чтобы вызывающий код обработал его через raise_for_status.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+
+        attempt = 0
+        while True:
+            # Срок проверяется до allow(), чтобы не занять пробный запрос полуоткрытого размыкателя
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count_failure('deadline')
+                raise requests.Timeout(f"{self.name}: истёк срок ожидания")
+            timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+            if not self.breaker.allow():
+                self._count_failure('circuit_open')
+                raise CircuitOpenError(f"{self.name} временно недоступен")
+
+            # После allow() каждый исход должен дойти до размыкателя
+            response = None
+            retry_after = None
+            try:
+                response = self._send_hedged(timeout, kwargs)
+            except requests.Timeout as e:
+                self.breaker.record_failure()
+                self._count_failure('timeout')
+                error = e
+            except requests.ConnectionError as e:
+                self.breaker.record_failure()
+                self._count_failure('connection')
+                error = e
+            except BaseException:
+                self.breaker.record_abort()
+                raise
+            else:
+                if response.status_code not in self.RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                # 429 - превышена квота, но сервис отвечает: для размыкателя это успех
+                if response.status_code == 429:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+                self._count_failure(f"http_{response.status_code}")
+                retry_after = self._retry_after(response)
+                error = None
+
+            attempt += 1
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(self.backoff_max, self.backoff_base * 2 ** attempt)
+            )
+            if attempt > self.max_retries or time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return response
+
+            if response is not None:
+                response.close()
+            with self._lock:
+                self._retries += 1
+            logger.warning(f"{self.name}: повтор {attempt} через {delay:.1f} с")
+            time.sleep(delay)
+
+    def _send_hedged(self, timeout: tuple, kwargs: dict) -> requests.Response:
+        """Отправка запроса с дублированием, если ответа долго нет"""
+        if self._hedge_executor is None or kwargs.get('stream'):
+            return self._send(timeout, kwargs)
+
+        first = self._hedge_executor.submit(self._send, timeout, kwargs)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        with self._lock:
+            self._hedges += 1
+        second = self._hedge_executor.submit(self._send, timeout, kwargs)
+        done, pending = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None and pending:
+            return pending.pop().result()
+        return winner.result()
+
+    def _send(self, timeout: tuple, kwargs: dict) -> requests.Response:
+        """Одна попытка запроса с замером времени"""
+        _http_timing.connect = 0.0
+        _http_timing.tls = 0.0
+        started = time.perf_counter()
+
+        response = self.session.post(self.url, timeout=timeout, **kwargs)
+
+        # Для stream=True общее время - до получения заголовков
+        timing = {
+            'connect': _http_timing.connect,
+            'tls': _http_timing.tls,
+            'ttfb': response.elapsed.total_seconds(),
+            'total': time.perf_counter() - started,
+        }
+        response.timing = timing
+        logger.debug(
+            f"{self.name}: {response.status_code}, соединение {timing['connect'] * 1000:.0f} мс, "
+            f"TLS {timing['tls'] * 1000:.0f} мс, TTFB {timing['ttfb'] * 1000:.0f} мс, "
+            f"всего {timing['total'] * 1000:.0f} мс"
+        )
+
+        with self._lock:
+            self._requests += 1
+            if timing['connect']:
+                self._new_connections += 1
+            self._timings.append(timing)
+        return response
+
+    @staticmethod
+    def _retry_after(response: requests.Response):
+        """Задержка из заголовка Retry-After в секундах или None"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def _count_failure(self, kind: str) -> None:
+        with self._lock:
+            self._failures[kind] = self._failures.get(kind, 0) + 1
+
+    def stats(self) -> dict:
+        """Средние замеры по последним запросам, счётчики ошибок и повторов"""
+        with self._lock:
+            timings = list(self._timings)
+            result = {
+                'requests': self._requests,
+                'new_connections': self._new_connections,
+                'retries': self._retries,
+                'hedges': self._hedges,
+                'failures': dict(self._failures),
+                'breaker_state': self.breaker.state,
+                'breaker_opened': self.breaker.opened,
+            }
+
+        for key in ('connect', 'tls', 'ttfb', 'total'):
+            result[key] = sum(t[key] for t in timings) / len(timings) if timings else 0.0
+        return result
+
+    def close(self) -> None:
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        self.session.close()
+
+
+class DialogStep:
+    """Вопрос диалога, заданный данными"""
+
+    __slots__ = ('state', 'field', 'question', 'skip_reply', 'answer_reply', 'choices')
+
+    def __init__(self, state: ConversationState, field: str, question: str, skip_reply: str = None,
+                 answer_reply: str = None, choices: tuple = None):
+        self.state = state
+        self.field = field
+        self.question = question
+        # Реплика перед следующим вопросом: при пропуске и при ответе ({answer} - ответ)
+        self.skip_reply = skip_reply
+        self.answer_reply = answer_reply
+        # Варианты ответа кнопками; без них ответ пишется текстом и шаг можно пропустить
+        self.choices = choices
+
+
+class DialogEngine:
+    """Диалог как таблица шагов
+
+    Следующий шаг - следующий в таблице, после последнего начинается
+    генерация. Кнопка варианта присылает "{field}_{значение}", кнопка
+    пропуска - "skip_{field}". Шаг находится по состоянию или префиксу
+    callback_data за O(1), клавиатуры строятся один раз.
+    """
+
+    def __init__(self, steps: tuple):
+        self.steps = steps
+        self.first = steps[0]
+        self._by_state = {step.state: step for step in steps}
+        self._by_field = {step.field: step for step in steps}
+        self._next = {step.state: following for step, following in zip(steps, steps[1:] + (None,))}
+        self._values = {step.state: frozenset(value for value, _ in step.choices or ()) for step in steps}
+        self.keyboards = {step.state: self._keyboard(step) for step in steps}
+
+    @staticmethod
+    def _keyboard(step: DialogStep) -> InlineKeyboardMarkup:
+        if not step.choices:
+            return InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data=f"skip_{step.field}")]])
+        buttons = [InlineKeyboardButton(label, callback_data=f"{step.field}_{value}") for value, label in step.choices]
+        return InlineKeyboardMarkup([buttons[i:i + 3] for i in range(0, len(buttons), 3)])
+
+    def step(self, state: ConversationState):
+        """Шаг для состояния или None"""
+        return self._by_state.get(state)
+
+    def parse_callback(self, data: str) -> tuple:
+        """Шаг и ответ по callback_data (ответ None - пропуск); (None, None) для чужих данных"""
+        prefix, _, value = data.partition('_')
+        if prefix == 'skip':
+            step = self._by_field.get(value)
+            return (step, None) if step is not None and not step.choices else (None, None)
+        step = self._by_field.get(prefix)
+        if step is None or value not in self._values[step.state]:
+            return None, None
+        return step, value
+
+    def answer(self, session: Session, step: DialogStep, value) -> tuple:
+        """Сохранение ответа (None - пропуск), следующий шаг и текст для пользователя"""
+        session.answers[step.field] = value if value is not None else ""
+        following = self._next[step.state]
+        if value is None:
+            reply = step.skip_reply
+        else:
+            reply = step.answer_reply.format(answer=value) if step.answer_reply else None
+        if following is None:
+            return None, reply
+        return following, f"{reply}\n\n{following.question}" if reply else following.question
+
+
 class FairyTaleBot:
+    # Адреса можно переопределить, например для нагрузочного стенда с заглушками
+    GPT_URL = os.getenv("YANDEX_GPT_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+    TTS_URL = os.getenv("YANDEX_TTS_URL", "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize")
+    VOICES = {
+        'male': 'filipp',
+        'female': 'alena',
+        'cartoon': 'zahar'
+    }
+    # Вопросы диалога по порядку
+    DIALOG = (
+        DialogStep(ConversationState.AGE, 'age', "👶 Сколько лет вашему ребёнку? (От 2 до 10 лет)",
+                   answer_reply="Отлично, будем создавать сказку для {answer}-летнего ребёнка.",
+                   choices=tuple((str(age), str(age)) for age in range(2, 11))),
+        DialogStep(ConversationState.NAME, 'name', "📛 Как зовут вашего ребёнка? (Напишите имя)",
+                   skip_reply="Хорошо, сказка будет без имени.",
+                   answer_reply="Прекрасное имя - {answer}!"),
+        DialogStep(ConversationState.FAMILY, 'family',
+                   "👨‍👩‍👧‍👦 Напишите, кто есть в вашей семье (родители, братья/сёстры).",
+                   skip_reply="Хорошо, пропускаем информацию о семье."),
+        DialogStep(ConversationState.PETS, 'pets', "🐶 Есть ли у вашего ребёнка питомцы? Опишите их.",
+                   skip_reply="Хорошо, пропускаем информацию о питомцах."),
+        DialogStep(ConversationState.INTERESTS, 'interests',
+                   "🎨 Какие увлечения у вашего ребёнка? (игрушки, герои, занятия)",
+                   skip_reply="Хорошо, пропускаем информацию об интересах."),
+        DialogStep(ConversationState.SITUATION, 'situation', "🛑 Какая ситуация или проблема у ребёнка?",
+                   skip_reply="Хорошо, пропускаем информацию о ситуации."),
+        DialogStep(ConversationState.REQUEST, 'request', "📝 Какой должен быть сюжет или посыл сказки?"),
+    )
+
+    # Параметры синтеза SpeechKit: формат oggopus или lpcm, частота дискретизации для lpcm
+    TTS_SPEED = os.getenv("TTS_SPEED", "1.0")
+    TTS_FORMAT = os.getenv("TTS_FORMAT", "oggopus")
+    TTS_SAMPLE_RATE = int(os.getenv("TTS_SAMPLE_RATE", "48000"))
+
     def __init__(self):
-        self.user_data = {}
+        self.metrics = Metrics(enabled=os.getenv("METRICS_ENABLED", "1") == "1")
+
+        # Диалог и клавиатуры строятся один раз; нажатия кнопок маршрутизируются по префиксу
+        self.dialog = DialogEngine(self.DIALOG)
+        self._start_keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Начать создание сказки", callback_data='start_creation')]]
+        )
+        self._voice_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔊 Мужской голос", callback_data='voice_male'),
+             InlineKeyboardButton("🔊 Женский голос", callback_data='voice_female')],
+            [InlineKeyboardButton("🔊 Мультяшный голос", callback_data='voice_cartoon'),
+             InlineKeyboardButton("❌ Без озвучки", callback_data='voice_none')]
+        ])
+        self._callback_routes = {
+            'start': self.start_creation,
+            'voice': self.process_voice_selection,
+        }
+
+        session_ttl = float(os.getenv("SESSION_TTL_HOURS", "48")) * 3600
+        session_db = os.getenv("SESSION_DB")
+        if session_db:
+            self.sessions = SqliteSessionStore(
+                session_db, session_ttl, flush_interval=float(os.getenv("SESSION_FLUSH_INTERVAL", "1.0"))
+            )
+        else:
+            self.sessions = MemorySessionStore(session_ttl)
+
         self.api_key = os.getenv("YANDEX_API_KEY")
         self.folder_id = os.getenv("YANDEX_FOLDER_ID")
         self.speech_api_key = os.getenv("YANDEX_SPEECH_API_KEY")
 
+        # Отдельные пулы для YandexGPT и SpeechKit, чтобы долгие вызовы
+        # не занимали потоки диспетчера Telegram
+        llm_workers = int(os.getenv("LLM_WORKERS", "4"))
+        self.llm_pool = WorkerPool("llm", llm_workers)
+        self.tts_pool = WorkerPool("tts", int(os.getenv("TTS_WORKERS", "2")))
+        # Сколько задание может ждать в очереди и когда сообщать пользователю его место
+        self.queue_max_wait = float(os.getenv("QUEUE_MAX_WAIT", "300"))
+        self.queue_notice_after = float(os.getenv("QUEUE_NOTICE_AFTER", "15"))
+        # При остановке выполняющимся заданиям даётся время завершиться, остальные сохраняются в журнал
+        self.drain_timeout = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+        self.journal_path = os.getenv("JOB_JOURNAL", "skazki-jobs.jsonl")
+        # Сказки, отложенные ограничением частоты: при остановке тоже сохраняются в журнал
+        self._delayed = {}
+        self._delayed_lock = threading.Lock()
+
+        # Потоковая выдача сказки с правкой сообщения по мере генерации
+        self.stream_enabled = os.getenv("GPT_STREAMING", "0") == "1"
+        self.stream_edit_interval = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+        # Озвучка длинной сказки по частям, общий лимит параллельных запросов к SpeechKit
+        self.tts_chunk_chars = min(int(os.getenv("TTS_CHUNK_CHARS", "1000")), 5000)
+        tts_chunk_workers = int(os.getenv("TTS_CHUNK_WORKERS", "4"))
+        self.tts_chunk_executor = ThreadPoolExecutor(
+            max_workers=tts_chunk_workers, thread_name_prefix="tts-chunk"
+        )
+
+        # Лимиты обращений к YandexGPT и SpeechKit, общие для всех чатов, и лимит на чат
+        rate_limit_db = os.getenv("RATE_LIMIT_DB")
+        gpt_rps = float(os.getenv("GPT_RPS", "0"))
+        gpt_tokens = float(os.getenv("GPT_TOKENS_PER_MIN", "0"))
+        tts_chars = float(os.getenv("TTS_CHARS_PER_MIN", "0"))
+        chat_tales = float(os.getenv("CHAT_TALES_PER_HOUR", "0"))
+        self.rate_limiter = RateLimiter(
+            SqliteBucketBackend(rate_limit_db) if rate_limit_db else MemoryBucketBackend(),
+            {
+                'gpt_requests': (gpt_rps, max(gpt_rps, 1)),
+                'gpt_tokens': (gpt_tokens / 60, gpt_tokens),
+                'tts_chars': (tts_chars / 60, tts_chars),
+                'chat_tales': (chat_tales / 3600, float(os.getenv("CHAT_TALES_BURST", "3"))),
+            }
+        )
+
+        # Одинаковые одновременные запросы к YandexGPT и SpeechKit выполняются один раз
+        self.gpt_flight = SingleFlight("llm")
+        self.tts_flight = SingleFlight("tts")
+        self.debounce_window = float(os.getenv("CALLBACK_DEBOUNCE", "2"))
+        self._recent_callbacks = {}
+        self._callbacks_lock = threading.Lock()
+        self.debounced = 0
+
+        # HTTP-клиенты: размер пула соединений равен числу параллельных запросов
+        connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+        read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+        max_retries = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+        breaker_failures = int(os.getenv("BREAKER_FAILURES", "5"))
+        breaker_reset = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+        self.gpt_client = YandexClient(
+            "YandexGPT", self.GPT_URL,
+            {
+                "Authorization": f"Api-Key {self.api_key}",
+                "Content-Type": "application/json",
+                "x-folder-id": self.folder_id or ""
+            },
+            llm_workers, connect_timeout, read_timeout,
+            deadline=float(os.getenv("GPT_DEADLINE", "60")),
+            max_retries=max_retries,
+            breaker=CircuitBreaker(breaker_failures, breaker_reset)
+        )
+        # Синтез идемпотентен, поэтому для SpeechKit допускается дублирование медленных запросов
+        self.tts_client = YandexClient(
+            "SpeechKit", self.TTS_URL,
+            {"Authorization": f"Api-Key {self.speech_api_key}"},
+            tts_chunk_workers, connect_timeout, read_timeout,
+            deadline=float(os.getenv("TTS_DEADLINE", "45")),
+            max_retries=max_retries,
+            hedge_after=float(os.getenv("TTS_HEDGE_AFTER", "0")),
+            breaker=CircuitBreaker(breaker_failures, breaker_reset)
+        )
+
+        # Упреждающая озвучка наиболее вероятным голосом, пока пользователь выбирает
+        self.speculation_enabled = os.getenv("TTS_SPECULATION", "0") == "1"
+        self.speculation_budget = float(os.getenv("TTS_SPECULATION_BUDGET", "30")) / 100
+        self.speculation_ttl = float(os.getenv("TTS_SPECULATION_TTL", "300"))
+        self._speculations = {}
+        self._speculation_lock = threading.Lock()
+        self._voice_popularity = {}
+        self._tts_chars = 0
+        self._speculation_chars = 0
+        self._speculation_stats = {'started': 0, 'hits': 0, 'misses': 0, 'wasted_chars': 0, 'over_budget': 0}
+
+        # Промпт в пределах бюджета токенов и выбор модели YandexGPT
+        self.prompt_builder = PromptBuilder(int(os.getenv("GPT_MAX_TOKENS", "2000")))
+        self.gpt_model = os.getenv("GPT_MODEL", "yandexgpt-lite")
+        self.gpt_model_full = os.getenv("GPT_MODEL_FULL", "")
+        self.gpt_full_max_queue = int(os.getenv("GPT_FULL_MAX_QUEUE", "0"))
+        self.gpt_full_min_headroom = float(os.getenv("GPT_FULL_MIN_HEADROOM", "50")) / 100
+
+        # Запас готовых сказок для запросов без персонализации, пополняется в спокойные часы
+        self.tale_pool = TalePool(
+            depth=int(os.getenv("TALE_POOL_DEPTH", "0")),
+            max_age=float(os.getenv("TALE_POOL_MAX_AGE_HOURS", "24")) * 3600,
+            max_uses=int(os.getenv("TALE_POOL_MAX_USES", "1"))
+        )
+        self.tale_pool_hours = self._parse_hours(os.getenv("TALE_POOL_HOURS", ""))
+        self._pool_stop = threading.Event()
+        self._pool_thread = None
+        if self.tale_pool.depth > 0:
+            self._pool_thread = threading.Thread(target=self._refill_tale_pool, name="tale-pool", daemon=True)
+            self._pool_thread.start()
+
+        # Буфер озвучки в памяти с переносом на диск для очень длинных сказок
+        self.audio_memory_limit = int(os.getenv("AUDIO_MEMORY_LIMIT_MB", "20")) * 1024 * 1024
+        self.audio_spill_dir = os.getenv("AUDIO_SPILL_DIR") or None
+
+        # Выходной файл озвучки и способ доставки: голосовое сообщение или аудиофайл
+        self.audio_encoder = AudioEncoder(self.TTS_FORMAT, self.TTS_SAMPLE_RATE, os.getenv("AUDIO_BITRATE", ""))
+        self.audio_delivery = os.getenv("AUDIO_DELIVERY", "auto")
+        self.voice_max_bytes = float(os.getenv("AUDIO_VOICE_MAX_MB", "1")) * 1024 * 1024
+        # Ключ кэша учитывает всё, что меняет файл; для oggopus по умолчанию он прежний
+        self.audio_format_key = self.TTS_FORMAT
+        if self.TTS_FORMAT == 'lpcm':
+            self.audio_format_key += f":{self.TTS_SAMPLE_RATE}:{self.audio_encoder.container}"
+        if self.audio_encoder.ffmpeg and self.audio_encoder.bitrate:
+            self.audio_format_key += f"@{self.audio_encoder.bitrate}"
+
+        # Кэш готовой озвучки
+        self.audio_cache = AudioCache(
+            directory=os.getenv("AUDIO_CACHE_DIR") or None,
+            max_bytes=int(os.getenv("AUDIO_CACHE_MAX_MB", "500")) * 1024 * 1024
+        )
+
+        self._register_gauges()
+
+    def _register_gauges(self) -> None:
+        """Датчики и накопительные счётчики очередей, клиентов и кэшей для /metrics"""
+        for pool in (self.llm_pool, self.tts_pool):
+            self.metrics.gauge('queue_depth', lambda p=pool: p.stats()['depth'], pool=pool.name)
+            self.metrics.gauge('queue_in_flight', lambda p=pool: p.stats()['in_flight'], pool=pool.name)
+            self.metrics.gauge('queue_wait_p95_seconds', lambda p=pool: p.stats()['wait_p95'], pool=pool.name)
+            self.metrics.counter('queue_shed_total', lambda p=pool: p.stats()['shed'], pool=pool.name)
+        for client in (self.gpt_client, self.tts_client):
+            self.metrics.counter('upstream_requests_total', lambda c=client: c.stats()['requests'], upstream=client.name)
+            self.metrics.counter('upstream_retries_total', lambda c=client: c.stats()['retries'], upstream=client.name)
+            self.metrics.gauge(
+                'upstream_breaker_open', lambda c=client: c.breaker.state != CircuitBreaker.CLOSED,
+                upstream=client.name
+            )
+        self.metrics.gauge('audio_cache_hit_ratio', lambda: self.audio_cache.stats()['hit_ratio'])
+        self.metrics.counter('audio_cache_bytes_saved_total', lambda: self.audio_cache.stats()['bytes_saved'])
+        self.metrics.gauge('sessions', lambda: len(self.sessions))
+        self.metrics.counter('coalesced_requests_total', lambda: self.gpt_flight.shared, upstream='llm')
+        self.metrics.counter('coalesced_requests_total', lambda: self.tts_flight.shared, upstream='tts')
+        self.metrics.counter('debounced_callbacks_total', lambda: self.debounced)
+        self.metrics.counter('prompt_fields_truncated_total', lambda: self.prompt_builder.truncated)
+        self.metrics.gauge('tale_pool_size', lambda: self.tale_pool.stats()['size'])
+        self.metrics.counter('tale_pool_served_total', lambda: self.tale_pool.stats()['served'])
+        self.metrics.gauge('tts_speculation_hit_ratio', lambda: self.speculation_stats()['hit_ratio'])
+        self.metrics.counter('tts_speculation_wasted_chars_total', lambda: self.speculation_stats()['wasted_chars'])
+
     def start(self, update: Update, context: CallbackContext) -> None:
         """Обработчик команды /start"""
-        self.user_data[update.effective_chat.id] = {
-            'state': ConversationState.START,
-            'answers': {}
-        }
-
-        keyboard = [
-            [InlineKeyboardButton("Начать создание сказки", callback_data='start_creation')]
-        ]
+        previous = self.sessions.get(update.effective_chat.id)
+        session = self.sessions.create(update.effective_chat.id)
+        if previous is not None:
+            session.last_voice = previous.last_voice
+            session.tales = previous.tales
+        self.metrics.inc('state_transitions_total', state=ConversationState.START.name)
 
         update.message.reply_text(
             "📖 Добро пожаловать в СказкоБот!\n\n"
             "Я помогу создать персонализированную сказку для вашего ребёнка.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=self._start_keyboard
         )
 
     def start_creation(self, update: Update, context: CallbackContext) -> None:
@@ -63,241 +1902,299 @@ class FairyTaleBot:
         query = update.callback_query
         query.answer()
 
-        chat_id = query.message.chat_id
-        self.user_data[chat_id]['state'] = ConversationState.AGE
+        session = self._get_session(update)
+        if session is None:
+            return
 
-        query.edit_message_text(
-            "👶 Сколько лет вашему ребёнку? (От 2 до 10 лет)",
-            reply_markup=self._age_keyboard()
-        )
+        first = self.dialog.first
+        self._set_state(session, first.state)
+        query.edit_message_text(first.question, reply_markup=self.dialog.keyboards[first.state])
 
-    def _age_keyboard(self):
-        """Клавиатура для выбора возраста"""
-        ages = [str(i) for i in range(2, 11)]
-        buttons = [InlineKeyboardButton(age, callback_data=f"age_{age}") for age in ages]
-        keyboard = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
-        return InlineKeyboardMarkup(keyboard)
+    def _set_state(self, session: Session, state: ConversationState) -> None:
+        """Переход диалога в новое состояние"""
+        session.state = state
+        self.sessions.save(session)
+        self.metrics.inc('state_transitions_total', state=state.name)
 
-    def process_age(self, update: Update, context: CallbackContext) -> None:
-        """Обработка выбора возраста"""
+    def debounce_callback(self, update: Update, context: CallbackContext) -> None:
+        """Отбрасывание повторного нажатия той же кнопки в том же чате"""
         query = update.callback_query
-        query.answer()
-
-        chat_id = query.message.chat_id
-        age = query.data.split('_')[1]
-        self.user_data[chat_id]['answers']['age'] = age
-        self.user_data[chat_id]['state'] = ConversationState.NAME
-
-        query.edit_message_text(
-            f"Отлично, будем создавать сказку для {age}-летнего ребёнка.\n\n"
-            "📛 Как зовут вашего ребёнка? (Напишите имя)",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data="skip_name")]])
-        )
-
-    def process_name(self, update: Update, context: CallbackContext) -> None:
-        """Обработка имени ребёнка"""
-        chat_id = update.effective_chat.id
-
-        if update.callback_query and update.callback_query.data == "skip_name":
-            self.user_data[chat_id]['answers']['name'] = ""
-            update.callback_query.answer()
-            update.callback_query.edit_message_text(
-                "Хорошо, сказка будет без имени.\n\n"
-                "👨‍👩‍👧‍👦 Напишите, кто есть в вашей семье (родители, братья/сёстры).",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data="skip_family")]])
-            )
+        key = (query.message.chat_id, query.message.message_id, query.data)
+        now = time.monotonic()
+
+        with self._callbacks_lock:
+            last = self._recent_callbacks.get(key)
+            self._recent_callbacks[key] = now
+            if len(self._recent_callbacks) > 10000:
+                deadline = now - self.debounce_window
+                self._recent_callbacks = {k: t for k, t in self._recent_callbacks.items() if t >= deadline}
+            duplicate = last is not None and now - last < self.debounce_window
+            if duplicate:
+                self.debounced += 1
+
+        if duplicate:
+            query.answer()
+            raise DispatcherHandlerStop()
+
+    def _get_session(self, update: Update):
+        """Сессия чата; если её нет, пользователю предлагается начать заново"""
+        session = self.sessions.get(update.effective_chat.id)
+        if session is None:
+            update.effective_message.reply_text("Пожалуйста, начните с команды /start")
+        return session
+
+    def handle_callback(self, update: Update, context: CallbackContext) -> None:
+        """Маршрутизация нажатий кнопок по префиксу callback_data"""
+        route = self._callback_routes.get(update.callback_query.data.partition('_')[0], self.process_answer)
+        route(update, context)
+
+    def process_answer(self, update: Update, context: CallbackContext) -> None:
+        """Ответ на текущий вопрос диалога кнопкой или текстом"""
+        query = update.callback_query
+        if query:
+            query.answer()
+        session = self._get_session(update)
+        if session is not None:
+            self._answer(update, context, session)
+
+    def _answer(self, update: Update, context: CallbackContext, session: Session) -> None:
+        """Переход диалога к следующему вопросу или к генерации"""
+        query = update.callback_query
+        if query:
+            step, value = self.dialog.parse_callback(query.data)
+            # Кнопка из старого сообщения не должна перескакивать через вопросы
+            if step is None or step.state != session.state:
+                return
         else:
-            name = update.message.text
-            self.user_data[chat_id]['answers']['name'] = name
-            update.message.reply_text(
-                f"Прекрасное имя - {name}!\n\n"
-                "👨‍👩‍👧‍👦 Напишите, кто есть в вашей семье (родители, братья/сёстры).",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data="skip_family")]])
-            )
-
-        self.user_data[chat_id]['state'] = ConversationState.FAMILY
-
-    def process_family(self, update: Update, context: CallbackContext) -> None:
-        """Обработка информации о семье"""
-        chat_id = update.effective_chat.id
+            step, value = self.dialog.step(session.state), update.message.text
+            if step is None or step.choices:
+                update.message.reply_text("Пожалуйста, следуйте инструкциям или начните заново с /start")
+                return
+
+        following, text = self.dialog.answer(session, step, value)
+        if following is None:
+            self._request_tale(update, context, session)
+            return
 
-        if update.callback_query and update.callback_query.data == "skip_family":
-            self.user_data[chat_id]['answers']['family'] = ""
-            update.callback_query.answer()
-            update.callback_query.edit_message_text(
-                "Хорошо, пропускаем информацию о семье.\n\n"
-                "🐶 Есть ли у вашего ребёнка питомцы? Опишите их.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data="skip_pets")]])
-            )
+        self._set_state(session, following.state)
+        if query:
+            query.edit_message_text(text, reply_markup=self.dialog.keyboards[following.state])
         else:
-            text = update.message.text if hasattr(update, 'message') else ""
-            self.user_data[chat_id]['answers']['family'] = text
-            update.message.reply_text(
-                "🐶 Есть ли у вашего ребёнка питомцы? Опишите их.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data="skip_pets")]])
+            update.message.reply_text(text, reply_markup=self.dialog.keyboards[following.state])
+
+    def _request_tale(self, update: Update, context: CallbackContext, session: Session) -> None:
+        """Запуск генерации после последнего ответа"""
+        chat_id = session.chat_id
+
+        # Генерация сказки выполняется в пуле, обработчик сразу освобождается
+        self._set_state(session, ConversationState.GENERATING)
+
+        # Слишком частые сказки в одном чате откладываются, а не отклоняются
+        delay = self.rate_limiter.reserve('chat_tales', key=chat_id)
+        if delay <= 0:
+            # Для запроса без персонализации может найтись готовая сказка
+            fairy_tale = self.tale_pool.take(session.answers, chat_id)
+            if fairy_tale is not None:
+                self._deliver_fairy_tale(context.bot, session, fairy_tale)
+                return
+        else:
+            update.effective_message.reply_text(
+                f"⏳ Вы заказали много сказок подряд. Начнём сочинять через {int(delay) + 1} с."
             )
+            with self._delayed_lock:
+                self._delayed[chat_id] = session
+            context.job_queue.run_once(lambda ctx: self._submit_delayed(ctx.bot, session), delay)
+            return
 
-        self.user_data[chat_id]['state'] = ConversationState.PETS
+        context.bot.send_chat_action(chat_id=chat_id, action="typing")
+        self._submit_fairy_tale(context.bot, session)
+
+    def _submit_delayed(self, bot, session: Session) -> None:
+        """Постановка отложенной сказки, если её ещё не забрала остановка"""
+        with self._delayed_lock:
+            if self._delayed.get(session.chat_id) is not session:
+                return
+            del self._delayed[session.chat_id]
+        self._submit_fairy_tale(bot, session)
+
+    @staticmethod
+    def _tale_journal(session: Session) -> dict:
+        """Описание генерации сказки для журнала заданий"""
+        return {'kind': 'tale', 'chat_id': session.chat_id, 'answers': session.answers, 'tales': session.tales}
+
+    def _submit_fairy_tale(self, bot, session: Session) -> None:
+        """Постановка генерации в очередь: первая сказка чата важнее повторных"""
+        chat_id = session.chat_id
+
+        def on_shed():
+            self._set_state(session, ConversationState.REQUEST)
+            bot.send_message(
+                chat_id=chat_id,
+                text="😔 Сейчас слишком много желающих, и сказку не удалось начать вовремя.\n\n"
+                     "Отправьте пожелание ещё раз или начните заново с /start"
+            )
 
-    def process_pets(self, update: Update, context: CallbackContext) -> None:
-        """Обработка информации о питомцах"""
-        chat_id = update.effective_chat.id
+        def on_wait(position):
+            bot.send_message(chat_id=chat_id, text=f"⏳ Сейчас много желающих послушать сказку. Вы {position}-й в очереди.")
 
-        if update.callback_query and update.callback_query.data == "skip_pets":
-            self.user_data[chat_id]['answers']['pets'] = ""
-            update.callback_query.answer()
-            update.callback_query.edit_message_text(
-                "Хорошо, пропускаем информацию о питомцах.\n\n"
-                "🎨 Какие увлечения у вашего ребёнка? (игрушки, герои, занятия)",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("Пропустить", callback_data="skip_interests")]])
-            )
-        else:
-            text = update.message.text if hasattr(update, 'message') else ""
-            self.user_data[chat_id]['answers']['pets'] = text
-            update.message.reply_text(
-                "🎨 Какие увлечения у вашего ребёнка? (игрушки, герои, занятия)",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("Пропустить", callback_data="skip_interests")]])
-            )
+        self.llm_pool.submit(
+            self._deliver_fairy_tale, bot, session,
+            chat_id=chat_id,
+            priority=WorkerPool.REPEAT_TALE if session.tales else WorkerPool.FIRST_TALE,
+            max_wait=self.queue_max_wait, on_shed=on_shed, on_wait=on_wait,
+            journal=self._tale_journal(session)
+        )
 
-        self.user_data[chat_id]['state'] = ConversationState.INTERESTS
+    def _deliver_fairy_tale(self, bot, session: 'Session', fairy_tale: str = None) -> None:
+        """Генерация сказки (если она не передана готовой) и отправка её в чат"""
+        chat_id = session.chat_id
+        message = StreamingMessage(bot, chat_id, self.stream_edit_interval)
+        if fairy_tale is None:
+            on_text = message.update if self.stream_enabled else None
+            with self.metrics.timer('prompt'):
+                prompt = self._generate_prompt(session.answers)
+            max_tokens = self.prompt_builder.max_tokens(session.answers.get('age'))
+            fairy_tale = self._generate_fairy_tale(prompt, max_tokens, on_text)
+            if fairy_tale is None:
+                # Озвучивать нечего: пожелание можно отправить ещё раз
+                self._set_state(session, ConversationState.REQUEST)
+                message.finish(
+                    "Извините, не удалось создать сказку. Пожалуйста, попробуйте позже.\n\n"
+                    "Отправьте пожелание ещё раз или начните заново с /start"
+                )
+                return
 
-    def process_interests(self, update: Update, context: CallbackContext) -> None:
-        """Обработка информации об интересах"""
-        chat_id = update.effective_chat.id
+        # Сохраняем сказку; счётчик растёт только после удачной генерации,
+        # иначе повтор первой сказки попал бы в класс REPEAT_TALE
+        session.fairy_tale = fairy_tale
+        session.tales += 1
+        self._set_state(session, ConversationState.VOICE_SELECTION)
 
-        if update.callback_query and update.callback_query.data == "skip_interests":
-            self.user_data[chat_id]['answers']['interests'] = ""
-            update.callback_query.answer()
-            update.callback_query.edit_message_text(
-                "Хорошо, пропускаем информацию об интересах.\n\n"
-                "🛑 Какая ситуация или проблема у ребёнка?",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("Пропустить", callback_data="skip_situation")]])
-            )
-        else:
-            text = update.message.text if hasattr(update, 'message') else ""
-            self.user_data[chat_id]['answers']['interests'] = text
-            update.message.reply_text(
-                "🛑 Какая ситуация или проблема у ребёнка?",
-                reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("Пропустить", callback_data="skip_situation")]])
-            )
+        # Отправляем сказку (при потоковой генерации - дописываем последнюю правку)
+        with self.metrics.timer('send_text'):
+            message.finish(fairy_tale)
 
-        self.user_data[chat_id]['state'] = ConversationState.SITUATION
+        # Кнопки выбора голоса
+        bot.send_message(
+            chat_id=chat_id,
+            text="Выберите вариант озвучки сказки:",
+            reply_markup=self._voice_keyboard
+        )
 
-    def process_situation(self, update: Update, context: CallbackContext) -> None:
-        """Обработка информации о ситуации"""
-        chat_id = update.effective_chat.id
+        if self.speculation_enabled:
+            self._speculate(session)
 
-        if update.callback_query and update.callback_query.data == "skip_situation":
-            self.user_data[chat_id]['answers']['situation'] = ""
-            update.callback_query.answer()
-            update.callback_query.edit_message_text(
-                "Хорошо, пропускаем информацию о ситуации.\n\n"
-                "📝 Какой должен быть сюжет или посыл сказки?",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data="skip_request")]])
-            )
-        else:
-            text = update.message.text if hasattr(update, 'message') else ""
-            self.user_data[chat_id]['answers']['situation'] = text
-            update.message.reply_text(
-                "📝 Какой должен быть сюжет или посыл сказки?",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Пропустить", callback_data="skip_request")]])
+    def _speculate(self, session: Session) -> None:
+        """Запуск озвучки наиболее вероятным голосом до выбора пользователя"""
+        with self._speculation_lock:
+            voice_type = session.last_voice or max(
+                self._voice_popularity, key=self._voice_popularity.get, default=None
             )
+        if voice_type in (None, 'none'):
+            return
 
-        self.user_data[chat_id]['state'] = ConversationState.REQUEST
-
-    def process_request(self, update: Update, context: CallbackContext) -> None:
-        """Обработка запроса на сказку"""
-        chat_id = update.effective_chat.id
+        voice = self.VOICES.get(voice_type, 'filipp')
+        cache_key = AudioCache.key(session.fairy_tale, voice, self.TTS_SPEED, self.audio_format_key)
+        if cache_key in self.audio_cache:
+            return
 
-        if update.callback_query and update.callback_query.data == "skip_request":
-            self.user_data[chat_id]['answers']['request'] = ""
-            update.callback_query.answer()
-        else:
-            text = update.message.text if hasattr(update, 'message') else ""
-            self.user_data[chat_id]['answers']['request'] = text
+        # Упреждающая озвучка не должна превышать заданную долю всех символов SpeechKit
+        chars = len(session.fairy_tale)
+        with self._speculation_lock:
+            if self._speculation_chars + chars > self.speculation_budget * (self._tts_chars + chars):
+                self._speculation_stats['over_budget'] += 1
+                return
+            self._speculation_chars += chars
+            self._tts_chars += chars
+            self._speculation_stats['started'] += 1
+            speculation = Speculation(voice_type, session.fairy_tale)
+            previous = self._speculations.get(session.chat_id)
+            self._speculations[session.chat_id] = speculation
+        if previous is not None:
+            previous.cancelled.set()
+
+        self.tts_pool.submit(
+            self._run_speculation, speculation,
+            chat_id=session.chat_id, priority=WorkerPool.BACKGROUND, max_wait=self.speculation_ttl
+        )
 
-        # Генерация сказки
-        context.bot.send_chat_action(chat_id=chat_id, action="typing")
-        fairy_tale = self._generate_fairy_tale(self._generate_prompt(self.user_data[chat_id]['answers']))
+    def _run_speculation(self, speculation: Speculation) -> None:
+        """Задание упреждающей озвучки"""
+        if speculation.cancelled.is_set():
+            speculation.done.set()
+            return
 
-        # Сохраняем сказку
-        self.user_data[chat_id]['fairy_tale'] = fairy_tale
-        self.user_data[chat_id]['state'] = ConversationState.VOICE_SELECTION
+        speculation.started = True
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=self.audio_memory_limit, dir=self.audio_spill_dir) as audio:
+                if self._generate_voice(speculation.text, speculation.voice_type, audio, speculation.cancelled):
+                    audio.seek(0)
+                    speculation.audio = audio.read()
+        finally:
+            speculation.done.set()
 
-        # Отправляем сказку
-        if hasattr(update, 'message'):
-            update.message.reply_text(fairy_tale)
-        else:
-            update.callback_query.message.reply_text(fairy_tale)
+    def _claim_speculation(self, chat_id: int, voice_type: str, text: str):
+        """Упреждающая озвучка для выбранного голоса; несовпадающая отменяется"""
+        with self._speculation_lock:
+            speculation = self._speculations.pop(chat_id, None)
+            if speculation is None:
+                return None
 
-        # Кнопки выбора голоса
-        keyboard = [
-            [InlineKeyboardButton("🔊 Мужской голос", callback_data='voice_male'),
-             InlineKeyboardButton("🔊 Женский голос", callback_data='voice_female')],
-            [InlineKeyboardButton("🔊 Мультяшный голос", callback_data='voice_cartoon'),
-             InlineKeyboardButton("❌ Без озвучки", callback_data='voice_none')]
-        ]
+            expired = time.monotonic() - speculation.created > self.speculation_ttl
+            if expired or speculation.voice_type != voice_type or speculation.text != text:
+                self._speculation_stats['misses'] += 1
+                self._speculation_stats['wasted_chars'] += len(speculation.text)
+                speculation.cancelled.set()
+                return None
 
-        if hasattr(update, 'message'):
-            update.message.reply_text(
-                "Выберите вариант озвучки сказки:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            update.callback_query.message.reply_text(
-                "Выберите вариант озвучки сказки:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            self._speculation_stats['hits'] += 1
+            return speculation
 
     def _generate_prompt(self, answers: dict) -> str:
         """Генерация промпта для ИИ"""
-        prompt = "Напиши детскую сказку со следующими параметрами:\n"
-        prompt += f"- Возраст ребёнка: {answers.get('age', 'не указан')} лет\n"
-
-        if answers.get('name'):
-            prompt += f"- Главный герой: {answers['name']}\n"
-        if answers.get('family'):
-            prompt += f"- Члены семьи: {answers['family']}\n"
-        if answers.get('pets'):
-            prompt += f"- Питомцы: {answers['pets']}\n"
-        if answers.get('interests'):
-            prompt += f"- Интересы: {answers['interests']}\n"
-        if answers.get('situation'):
-            prompt += f"- Проблемная ситуация: {answers['situation']}\n"
-        if answers.get('request'):
-            prompt += f"- Желаемый посыл: {answers['request']}\n"
+        return self.prompt_builder.build(answers)
 
-        prompt += (
-            "\nТребования к сказке:\n"
-            "1. Простой язык по возрасту\n"
-            "2. Включи указанные персонажи\n"
-            "3. Ненавязчивый посыл\n"
-            "4. Увлекательный сюжет\n"
-            "5. Длина 500-700 слов\n"
-            "6. Диалоги и описания\n"
-            "7. Мораль в конце\n"
-            "Формат:\nНазвание\n\nТекст...\n\nМораль: ..."
-        )
-        return prompt
+    def _generate_fairy_tale(self, prompt: str, max_tokens: int, on_text=None):
+        """Генерация сказки через YandexGPT, текст сказки или None при ошибке
 
-    def _generate_fairy_tale(self, prompt: str) -> str:
-        """Генерация сказки через YandexGPT"""
-        headers = {
-            "Authorization": f"Api-Key {self.api_key}",
-            "Content-Type": "application/json",
-            "x-folder-id": self.folder_id
-        }
+        Если передан on_text, ответ запрашивается потоком и on_text
+        вызывается с накопленным текстом после каждого фрагмента. Вызов,
+        присоединившийся к такому же выполняющемуся запросу, получает
+        только итоговый текст.
+        """
+        payload = self._completion_payload(prompt, max_tokens, stream=on_text is not None)
 
-        payload = {
-            "modelUri": f"gpt://{self.folder_id}/yandexgpt-lite",
+        # Промпты без персонализации совпадают побайтно - одинаковые запросы объединяем
+        key = hashlib.sha256(json.dumps(
+            [payload["modelUri"], payload["completionOptions"]["temperature"],
+             payload["completionOptions"]["maxTokens"], prompt], ensure_ascii=False
+        ).encode('utf-8')).hexdigest()
+
+        try:
+            return self.gpt_flight.do(key, self._complete, payload, on_text)
+        except Exception as e:
+            logger.error(f"Ошибка генерации сказки: {str(e)}")
+            self.metrics.inc('errors_total', stage='llm', error=type(e).__name__)
+            return None
+
+    def _choose_model(self) -> str:
+        """Полная модель, если очередь короткая и квота токенов позволяет, иначе lite"""
+        if not self.gpt_model_full:
+            return self.gpt_model
+        if self.llm_pool.stats()['depth'] > self.gpt_full_max_queue:
+            return self.gpt_model
+        if self.rate_limiter.headroom('gpt_tokens') < self.gpt_full_min_headroom:
+            return self.gpt_model
+        return self.gpt_model_full
+
+    def _completion_payload(self, prompt: str, max_tokens: int, stream: bool, model: str = None) -> dict:
+        """Тело запроса к YandexGPT"""
+        return {
+            "modelUri": f"gpt://{self.folder_id}/{model or self._choose_model()}",
             "completionOptions": {
-                "stream": False,
+                "stream": stream,
                 "temperature": 0.7,
-                "maxTokens": 2000
+                "maxTokens": max_tokens
             },
             "messages": [
                 {
@@ -311,27 +2208,110 @@ class FairyTaleBot:
             ]
         }
 
+    def _refill_tale_pool(self) -> None:
+        """Фоновое пополнение запаса сказок, пока YandexGPT не занят пользователями"""
+        interval = float(os.getenv("TALE_POOL_REFILL_INTERVAL", "60"))
+        while not self._pool_stop.wait(interval):
+            while self._is_off_peak() and self.llm_pool.stats()['depth'] == 0 and not self._pool_stop.is_set():
+                key = self.tale_pool.wanted()
+                if key is None:
+                    break
+
+                age, kind = key
+                answers = {'age': age}
+                if kind == 'name':
+                    answers['name'] = TalePool.NAME_MARKER
+                prompt = self._generate_prompt(answers)
+                if kind == 'name':
+                    prompt += f"\nИмя героя всегда пиши ровно как {TalePool.NAME_MARKER}, не склоняя и не изменяя."
+
+                try:
+                    payload = self._completion_payload(
+                        prompt, self.prompt_builder.max_tokens(age), stream=False, model=self.gpt_model
+                    )
+                    self.tale_pool.put(key, self._complete(payload))
+                except Exception as e:
+                    logger.error(f"Ошибка пополнения запаса сказок: {str(e)}")
+                    break
+
+    @staticmethod
+    def _parse_hours(value: str):
+        """Окно часов вида 1-7 или 22-6 -> (начало, конец); пустое или неверное значение - None"""
+        if not value.strip():
+            return None
         try:
-            response = requests.post(
-                "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+            start, end = (int(hour) for hour in value.split('-'))
+        except ValueError:
+            start = end = -1
+        if not (0 <= start <= 23 and 0 <= end <= 24):
+            logger.error(f"Неверное значение TALE_POOL_HOURS={value!r}, запас будет пополняться в любое время")
+            return None
+        return start, end
+
+    def _is_off_peak(self) -> bool:
+        """Попадает ли текущий час в окно TALE_POOL_HOURS (например, 1-7 или 22-6)"""
+        if self.tale_pool_hours is None:
+            return True
+        start, end = self.tale_pool_hours
+        hour = time.localtime().tm_hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def _complete(self, payload: dict, on_text=None) -> str:
+        """Запрос к YandexGPT, текст сказки"""
+        stream = payload["completionOptions"]["stream"]
+        prompt = payload["messages"][-1]["text"]
+
+        # Токены ответа заранее неизвестны: резервируем токены промпта,
+        # а после ответа списываем фактически сгенерированные
+        self.rate_limiter.acquire(('gpt_requests', 1), ('gpt_tokens', PromptBuilder.estimate_tokens(prompt)))
+        self.metrics.inc('llm_requests_total', model=payload["modelUri"].rsplit('/', 1)[-1])
+        with self.metrics.timer('llm'):
+            response = self.gpt_client.post(json=payload, stream=stream)
             response.raise_for_status()
-            return response.json()["result"]["alternatives"][0]["message"]["text"]
-        except Exception as e:
-            logger.error(f"Ошибка генерации сказки: {str(e)}")
-            return "Извините, не удалось создать сказку. Пожалуйста, попробуйте позже."
+            if not stream:
+                result = response.json()["result"]
+            else:
+                # В потоковом режиме каждая строка - JSON с накопленным текстом
+                result = None
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    result = json.loads(line)["result"]
+                    if on_text is not None:
+                        try:
+                            on_text(result["alternatives"][0]["message"]["text"])
+                        except Exception as e:
+                            # Ошибка показа не должна срывать общий запрос к YandexGPT
+                            logger.warning(f"Ошибка потокового вывода: {str(e)}")
+                            on_text = None
+                if result is None:
+                    raise ValueError("пустой ответ")
+
+        completion_tokens = int(result.get("usage", {}).get("completionTokens", 0))
+        self.rate_limiter.reserve('gpt_tokens', completion_tokens)
+        return result["alternatives"][0]["message"]["text"]
 
     def process_voice_selection(self, update: Update, context: CallbackContext) -> None:
         """Обработка выбора голоса"""
         query = update.callback_query
         query.answer()
 
+        session = self._get_session(update)
+        if session is None:
+            return
+        # Кнопки озвучки из сообщения до /start не относятся к текущему диалогу
+        if session.state != ConversationState.VOICE_SELECTION or not session.fairy_tale:
+            return
+
         chat_id = query.message.chat_id
         voice_type = query.data.split('_')[1]
-        fairy_tale = self.user_data[chat_id]['fairy_tale']
+        fairy_tale = session.fairy_tale
+
+        session.last_voice = voice_type
+        self.sessions.save(session)
+        speculation = self._claim_speculation(chat_id, voice_type, fairy_tale)
+        with self._speculation_lock:
+            self._voice_popularity[voice_type] = self._voice_popularity.get(voice_type, 0) + 1
 
         if voice_type == 'none':
             context.bot.send_message(
@@ -340,121 +2320,682 @@ class FairyTaleBot:
             )
             return
 
-        # Создаем временный файл
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_file:
-            audio_file = temp_file.name
+        # Та же сказка тем же голосом уже загружалась в Telegram - отправляем сразу, без очереди
+        voice = self.VOICES.get(voice_type, 'filipp')
+        uploaded = self.audio_cache.get_file_id(
+            AudioCache.key(fairy_tale, voice, self.TTS_SPEED, self.audio_format_key)
+        )
+        if uploaded:
+            if speculation is not None:
+                speculation.cancelled.set()
+            file_id, kind = uploaded
+            try:
+                self._send_audio(context.bot, chat_id, file_id, kind)
+            except Exception as e:
+                logger.error(f"Ошибка озвучки: {str(e)}")
+                self.metrics.inc('errors_total', stage='voice', error=type(e).__name__)
+                context.bot.send_message(
+                    chat_id=chat_id,
+                    text="Произошла ошибка при озвучке."
+                )
+            context.bot.send_message(
+                chat_id=chat_id,
+                text="Чтобы создать новую сказку, отправьте /start"
+            )
+            return
 
-        # Озвучиваем
         processing_msg = context.bot.send_message(
             chat_id=chat_id,
             text="🔊 Озвучиваем сказку... Пожалуйста, подождите."
         )
 
+        self._submit_voice(context.bot, chat_id, fairy_tale, voice_type, processing_msg.message_id, speculation)
+
+    def _submit_voice(self, bot, chat_id: int, fairy_tale: str, voice_type: str,
+                      processing_msg_id: int, speculation: Speculation = None) -> None:
+        """Постановка озвучки в очередь SpeechKit"""
+
+        def on_shed():
+            bot.delete_message(chat_id=chat_id, message_id=processing_msg_id)
+            bot.send_message(
+                chat_id=chat_id,
+                text="😔 Озвучка не успела начаться из-за большой очереди. Вы можете прочитать сказку выше.\n\n"
+                     "Чтобы создать новую сказку, отправьте /start"
+            )
+
+        def on_wait(position):
+            bot.edit_message_text(
+                chat_id=chat_id, message_id=processing_msg_id,
+                text=f"🔊 Сказка ждёт озвучки, вы {position}-й в очереди. Пожалуйста, подождите."
+            )
+
+        self.tts_pool.submit(
+            self._deliver_voice, bot, chat_id, fairy_tale, voice_type, processing_msg_id, speculation,
+            chat_id=chat_id, priority=WorkerPool.VOICE, max_wait=self.queue_max_wait,
+            on_shed=on_shed, on_wait=on_wait,
+            journal={
+                'kind': 'voice', 'chat_id': chat_id, 'fairy_tale': fairy_tale, 'voice_type': voice_type,
+                'processing_msg_id': processing_msg_id
+            }
+        )
+
+    def _deliver_voice(self, bot, chat_id: int, fairy_tale: str, voice_type: str,
+                       processing_msg_id: int, speculation: Speculation = None) -> None:
+        """Озвучка сказки и отправка аудио в чат"""
+        voice = self.VOICES.get(voice_type, 'filipp')
+        cache_key = AudioCache.key(fairy_tale, voice, self.TTS_SPEED, self.audio_format_key)
+
         try:
-            if self._generate_voice(fairy_tale, voice_type, audio_file):
-                with open(audio_file, 'rb') as audio:
-                    context.bot.send_audio(
+            # Загруженная в Telegram озвучка отправляется ещё до очереди, здесь - только файл с диска
+            cached_path = self.audio_cache.get_path(cache_key)
+            if cached_path is not None:
+                size = os.path.getsize(cached_path)
+                kind = self._delivery_kind(size)
+                with open(cached_path, 'rb') as audio:
+                    message = self._send_audio(bot, chat_id, audio, kind, size)
+                self.audio_cache.put_file_id(cache_key, self._file_id(message), size, kind)
+                return
+
+            # Упреждающая озвучка ещё не начата - выполнять её в этом же пуле нельзя,
+            # поэтому отменяем и озвучиваем обычным порядком
+            if speculation is not None and not speculation.started:
+                speculation.cancelled.set()
+                speculation = None
+            # Общий срок озвучки: ожидание упреждающей озвучки входит в него
+            deadline = time.monotonic() + self.tts_client.deadline
+            if speculation is not None:
+                speculation.done.wait(max(0.0, deadline - time.monotonic()))
+
+            # Аудио держим в памяти; на диск попадает только очень длинная озвучка
+            with tempfile.SpooledTemporaryFile(
+                    max_size=self.audio_memory_limit, suffix='.ogg', dir=self.audio_spill_dir) as audio:
+                if speculation is not None and speculation.audio is not None:
+                    audio.write(speculation.audio)
+                elif not self._generate_voice(fairy_tale, voice_type, audio, deadline=deadline):
+                    bot.send_message(
                         chat_id=chat_id,
-                        audio=audio,
-                        caption="Ваша озвученная сказка!",
-                        title="Сказка",
-                        timeout=30
+                        text="Не удалось озвучить сказку. Вы можете прочитать её выше."
                     )
-            else:
-                context.bot.send_message(
-                    chat_id=chat_id,
-                    text="Не удалось озвучить сказку. Вы можете прочитать её выше."
-                )
+                    return
+
+                size = audio.tell()
+                kind = self._delivery_kind(size)
+                audio.seek(0)
+                self.audio_cache.put_file(cache_key, audio)
+                audio.seek(0)
+                message = self._send_audio(bot, chat_id, audio, kind, size)
+            self.audio_cache.put_file_id(cache_key, self._file_id(message), size, kind)
         except Exception as e:
             logger.error(f"Ошибка озвучки: {str(e)}")
-            context.bot.send_message(
+            self.metrics.inc('errors_total', stage='voice', error=type(e).__name__)
+            bot.send_message(
                 chat_id=chat_id,
                 text="Произошла ошибка при озвучке."
             )
         finally:
-            # Удаляем временные файлы и сообщения
-            if os.path.exists(audio_file):
-                os.remove(audio_file)
-            context.bot.delete_message(
+            # Удаляем служебное сообщение
+            bot.delete_message(
                 chat_id=chat_id,
-                message_id=processing_msg.message_id
+                message_id=processing_msg_id
             )
 
-            context.bot.send_message(
+            bot.send_message(
                 chat_id=chat_id,
                 text="Чтобы создать новую сказку, отправьте /start"
             )
 
-    def _generate_voice(self, text: str, voice_type: str, output_file: str) -> bool:
-        """Генерация аудио через SpeechKit"""
+    def _delivery_kind(self, size: int) -> str:
+        """Голосовое сообщение (только Ogg/Opus, не больше AUDIO_VOICE_MAX_MB) или аудиофайл"""
+        if self.audio_encoder.container != 'ogg' or self.audio_delivery == 'audio':
+            return 'audio'
+        if self.audio_delivery == 'voice' or size <= self.voice_max_bytes:
+            return 'voice'
+        return 'audio'
+
+    @staticmethod
+    def _file_id(message) -> str:
+        """file_id загруженного файла (WAV Telegram может сохранить как документ)"""
+        return (message.voice or message.audio or message.document).file_id
+
+    def _send_audio(self, bot, chat_id: int, audio, kind: str = 'audio', size: int = 0):
+        """Отправка озвучки файлом или по file_id с учётом объёма и времени загрузки"""
+        if size:
+            self.metrics.inc('upload_bytes_total', size, kind=kind)
+        with self.metrics.timer('upload', kind=kind):
+            if kind == 'voice':
+                return bot.send_voice(
+                    chat_id=chat_id,
+                    voice=audio,
+                    caption="Ваша озвученная сказка!",
+                    filename="skazka.ogg",
+                    timeout=30
+                )
+            return bot.send_audio(
+                chat_id=chat_id,
+                audio=audio,
+                caption="Ваша озвученная сказка!",
+                title="Сказка",
+                filename=f"skazka.{self.audio_encoder.container}",
+                timeout=30
+            )
+
+    def _generate_voice(self, text: str, voice_type: str, output, cancelled: threading.Event = None,
+                        deadline: float = None) -> bool:
+        """Генерация аудио через SpeechKit
+
+        Текст делится на части по абзацам и предложениям, части озвучиваются
+        параллельно и по порядку передаются выходному этапу, который пишет
+        готовый файл в файловый объект output.
+        Установка cancelled прерывает озвучку перед следующей частью.
+        deadline - момент time.monotonic(), к которому должны быть готовы
+        все части (по умолчанию через TTS_DEADLINE секунд).
+        """
         if not self.speech_api_key:
             logger.error("Не задан API ключ SpeechKit")
             return False
 
-        voice = {
-            'male': 'filipp',
-            'female': 'alena',
-            'cartoon': 'zahar'
-        }.get(voice_type, 'filipp')
+        voice = self.VOICES.get(voice_type, 'filipp')
+        if deadline is None:
+            deadline = time.monotonic() + self.tts_client.deadline
 
-        headers = {
-            "Authorization": f"Api-Key {self.speech_api_key}",
-        }
+        chunks = self._split_for_tts(text)
+        if cancelled is None:
+            with self._speculation_lock:
+                self._tts_chars += len(text)
 
-        data = {
-            "text": text[:5000],  # Ограничение API
-            "lang": "ru-RU",
-            "voice": voice,
-            "speed": "1.0",
-            "format": "oggopus",
-            "emotion": "good"
-        }
+        def synthesize(chunk):
+            if cancelled is not None and cancelled.is_set():
+                raise InterruptedError("озвучка отменена")
+            return self._synthesize_chunk(chunk, voice, deadline)
 
         try:
-            response = requests.post(
-                "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize",
-                headers=headers,
-                data=data,
-                stream=True,
-                timeout=30
-            )
-            response.raise_for_status()
-
-            with open(output_file, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # map сохраняет порядок частей независимо от порядка завершения
+            with self.metrics.timer('tts'):
+                audio_parts = list(self.tts_chunk_executor.map(synthesize, chunks))
+            with self.metrics.timer('encode'):
+                self.audio_encoder.encode(audio_parts, output)
             return True
+        except InterruptedError:
+            return False
         except Exception as e:
             logger.error(f"Ошибка SpeechKit: {str(e)}")
+            self.metrics.inc('errors_total', stage='tts', error=type(e).__name__)
             return False
 
+    def _synthesize_chunk(self, text: str, voice: str, deadline: float) -> bytes:
+        """Озвучка одной части текста (одинаковые одновременные запросы объединяются)"""
+        key = (voice, self.TTS_SPEED, self.TTS_FORMAT, self.TTS_SAMPLE_RATE, text)
+        return self.tts_flight.do(key, self._request_synthesis, text, voice, deadline)
+
+    def _request_synthesis(self, text: str, voice: str, deadline: float) -> bytes:
+        """Запрос к SpeechKit"""
+        data = {
+            "text": text,
+            "lang": "ru-RU",
+            "voice": voice,
+            "speed": self.TTS_SPEED,
+            "format": self.TTS_FORMAT,
+            "emotion": "good"
+        }
+        if self.TTS_FORMAT == 'lpcm':
+            data["sampleRateHertz"] = self.TTS_SAMPLE_RATE
+
+        # Ожидание лимита, которое не укладывается в срок озвучки, бессмысленно
+        delay = self.rate_limiter.reserve('tts_chars', len(text))
+        if time.monotonic() + delay >= deadline:
+            raise requests.Timeout(f"очередь лимита SpeechKit {delay:.1f} с не укладывается в срок озвучки")
+        if delay > 0:
+            time.sleep(delay)
+        response = self.tts_client.post(data=data, deadline=deadline)
+        response.raise_for_status()
+        return response.content
+
+    def _split_for_tts(self, text: str) -> list:
+        """Разбиение текста на части не длиннее лимита по границам абзацев и предложений"""
+        limit = self.tts_chunk_chars
+        pieces = []
+        for paragraph in text.split('\n'):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if len(paragraph) <= limit:
+                pieces.append(paragraph)
+                continue
+            for sentence in re.split(r'(?<=[.!?…])\s+', paragraph):
+                # Слишком длинное предложение режем по словам
+                while len(sentence) > limit:
+                    cut = sentence.rfind(' ', 0, limit)
+                    if cut <= 0:
+                        cut = limit
+                    pieces.append(sentence[:cut])
+                    sentence = sentence[cut:].lstrip()
+                if sentence:
+                    pieces.append(sentence)
+
+        # Склеиваем соседние куски, пока укладываемся в лимит
+        chunks = []
+        for piece in pieces:
+            if chunks and len(chunks[-1]) + 1 + len(piece) <= limit:
+                chunks[-1] += '\n' + piece
+            else:
+                chunks.append(piece)
+        return chunks
+
     def handle_message(self, update: Update, context: CallbackContext) -> None:
         """Обработка текстовых сообщений"""
-        chat_id = update.effective_chat.id
-
-        if chat_id not in self.user_data:
-            update.message.reply_text("Пожалуйста, начните с команды /start")
+        session = self._get_session(update)
+        if session is None:
             return
 
-        state = self.user_data[chat_id]['state']
-
-        if state == ConversationState.NAME:
-            self.process_name(update, context)
-        elif state == ConversationState.FAMILY:
-            self.process_family(update, context)
-        elif state == ConversationState.PETS:
-            self.process_pets(update, context)
-        elif state == ConversationState.INTERESTS:
-            self.process_interests(update, context)
-        elif state == ConversationState.SITUATION:
-            self.process_situation(update, context)
-        elif state == ConversationState.REQUEST:
-            self.process_request(update, context)
+        if session.state == ConversationState.GENERATING:
+            update.message.reply_text("✍️ Сказка уже сочиняется, подождите немного.")
         else:
-            update.message.reply_text(
-                "Пожалуйста, следуйте инструкциям или начните заново с /start"
+            self._answer(update, context, session)
+
+    def speculation_stats(self) -> dict:
+        """Счётчики упреждающей озвучки"""
+        with self._speculation_lock:
+            stats = dict(self._speculation_stats)
+            decided = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = stats['hits'] / decided if decided else 0.0
+            stats['share'] = self._speculation_chars / self._tts_chars if self._tts_chars else 0.0
+        return stats
+
+    def notify_queues(self, context: CallbackContext) -> None:
+        """Сообщение места в очереди пользователям, которые ждут дольше QUEUE_NOTICE_AFTER"""
+        for pool in (self.llm_pool, self.tts_pool):
+            pool.notify_waiting(self.queue_notice_after)
+
+    def log_stats(self, context: CallbackContext) -> None:
+        """Периодический вывод метрик очередей генерации и кэша озвучки"""
+        for pool in (self.llm_pool, self.tts_pool):
+            stats = pool.stats()
+            logger.info(
+                f"Пул {pool.name}: очередь {stats['depth']}, в работе {stats['in_flight']}/{stats['workers']}, "
+                f"ожидание avg {stats['wait_avg']:.2f}с p95 {stats['wait_p95']:.2f}с max {stats['wait_max']:.2f}с, "
+                f"выполнено {stats['completed']}, ошибок {stats['failed']}, отброшено {stats['shed']}"
+            )
+
+        for client in (self.gpt_client, self.tts_client):
+            stats = client.stats()
+            logger.info(
+                f"{client.name}: запросов {stats['requests']}, новых соединений {stats['new_connections']}, "
+                f"в среднем соединение {stats['connect'] * 1000:.0f} мс, TLS {stats['tls'] * 1000:.0f} мс, "
+                f"TTFB {stats['ttfb'] * 1000:.0f} мс, всего {stats['total'] * 1000:.0f} мс, "
+                f"повторов {stats['retries']}, дублей {stats['hedges']}, ошибки {stats['failures']}, "
+                f"размыкатель {stats['breaker_state']} (размыканий {stats['breaker_opened']})"
+            )
+
+        for line in self.metrics.summary():
+            logger.info(f"Метрики: {line}")
+
+        logger.info(
+            f"Объединено запросов: YandexGPT {self.gpt_flight.shared}, SpeechKit {self.tts_flight.shared}, "
+            f"отброшено повторных нажатий {self.debounced}"
+        )
+
+        for name, stats in self.rate_limiter.stats().items():
+            logger.info(f"Лимит {name}: ожиданий {stats['delayed']}, суммарно {stats['wait_total']:.1f} с")
+
+        if self.speculation_enabled:
+            stats = self.speculation_stats()
+            logger.info(
+                f"Упреждающая озвучка: запущено {stats['started']}, попаданий {stats['hit_ratio']:.0%}, "
+                f"промахов {stats['misses']}, впустую {stats['wasted_chars']} символов "
+                f"({stats['share']:.0%} всех символов), отказов по бюджету {stats['over_budget']}"
+            )
+
+        if self.tale_pool.depth > 0:
+            stats = self.tale_pool.stats()
+            logger.info(
+                f"Запас сказок: {stats['size']}, выдано {stats['served']}, не нашлось {stats['misses']}, "
+                f"сгенерировано {stats['generated']}, отброшено {stats['rejected']}, устарело {stats['expired']}"
             )
 
+        stats = self.audio_cache.stats()
+        logger.info(
+            f"Кэш озвучки: попаданий {stats['hit_ratio']:.0%} из {stats['lookups']} "
+            f"(file_id {stats['file_id_hits']}, диск {stats['disk_hits']}), "
+            f"сэкономлено {stats['bytes_saved'] / 1024 / 1024:.1f} МБ, на диске {stats['disk_bytes'] / 1024 / 1024:.1f} МБ"
+        )
+
+    def expire_sessions(self, context: CallbackContext) -> None:
+        """Периодическая очистка неактивных сессий и корзин лимитов"""
+        self.rate_limiter.cleanup()
+        with self._callbacks_lock:
+            deadline = time.monotonic() - self.debounce_window
+            self._recent_callbacks = {k: t for k, t in self._recent_callbacks.items() if t >= deadline}
+        with self._speculation_lock:
+            expired = [
+                chat_id for chat_id, speculation in self._speculations.items()
+                if time.monotonic() - speculation.created > self.speculation_ttl
+            ]
+            for chat_id in expired:
+                speculation = self._speculations.pop(chat_id)
+                speculation.cancelled.set()
+                self._speculation_stats['wasted_chars'] += len(speculation.text)
+        removed = self.sessions.expire()
+        if removed:
+            logger.info(f"Удалено неактивных сессий: {removed}, в памяти: {len(self.sessions)}")
+
+    def resume_jobs(self, bot) -> None:
+        """Возобновление заданий, сохранённых в журнал при прошлой остановке"""
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+        try:
+            with open(self.journal_path, encoding='utf-8') as journal:
+                entries = [json.loads(line) for line in journal if line.strip()]
+            os.remove(self.journal_path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка чтения журнала заданий: {str(e)}")
+            return
+
+        for entry in entries:
+            chat_id = entry['chat_id']
+            if entry['kind'] == 'tale':
+                session = self.sessions.get(chat_id) or self.sessions.create(chat_id)
+                session.answers = entry['answers']
+                session.tales = entry['tales']
+                self._set_state(session, ConversationState.GENERATING)
+                self._submit_fairy_tale(bot, session)
+            elif entry['kind'] == 'voice':
+                self._submit_voice(
+                    bot, chat_id, entry['fairy_tale'], entry['voice_type'], entry['processing_msg_id']
+                )
+        logger.info(f"Возобновлено заданий из журнала: {len(entries)}")
+
+    def _write_journal(self, entries: list) -> bool:
+        """Запись незавершённых заданий (дописывается к журналу, если он ещё не прочитан)"""
+        try:
+            with open(self.journal_path, 'a', encoding='utf-8') as journal:
+                for entry in entries:
+                    journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(f"Ошибка записи журнала заданий: {str(e)}")
+            return False
+        return True
+
+    def shutdown(self) -> None:
+        """Остановка пулов генерации с дожиданием текущих заданий и сохранение сессий"""
+        deadline = time.monotonic() + self.drain_timeout
+        self._pool_stop.set()
+
+        # Отложенные сказки ещё не в пуле, а задания JobQueue при остановке теряются
+        with self._delayed_lock:
+            delayed, self._delayed = list(self._delayed.values()), {}
+
+        # Сказка по завершении может поставить озвучку в очередь, поэтому пул SpeechKit останавливается вторым
+        drained, pending, dropped = 0, [self._tale_journal(session) for session in delayed], 0
+        for pool in (self.llm_pool, self.tts_pool):
+            report = pool.shutdown(max(0.0, deadline - time.monotonic()))
+            drained += report['drained']
+            pending += report['pending']
+            dropped += report['dropped']
+        if self._pool_thread is not None:
+            self._pool_thread.join(max(0.0, deadline - time.monotonic()))
+
+        if pending and not (self.journal_path and self._write_journal(pending)):
+            dropped += len(pending)
+            pending = []
+        logger.info(
+            f"Остановка: завершено заданий {drained}, сохранено для возобновления {len(pending)}, потеряно {dropped}"
+        )
+
+        # Незавершённые части озвучки не дожидаемся: задание уже в журнале
+        self.tts_chunk_executor.shutdown(wait=False)
+        self.gpt_client.close()
+        self.tts_client.close()
+        self.sessions.close()
+
+
+class WebhookServer:
+    """HTTP-сервер на asyncio для приёма обновлений Telegram
+
+    Проверяет путь и заголовок X-Telegram-Bot-Api-Secret-Token, передаёт
+    тело обновления в dispatch и сразу отвечает 200, не дожидаясь обработки.
+    """
+
+    MAX_BODY = 1024 * 1024
+
+    def __init__(self, path: str, secret: str, dispatch):
+        self.path = path
+        self.secret = secret.encode()
+        self.dispatch = dispatch
+        self.received = 0
+        self.rejected = 0
+
+    async def serve(self, host: str, port: int, stop: asyncio.Event) -> None:
+        """Работа сервера до установки события stop"""
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Вебхук слушает {host}:{port}{self.path}")
+        async with server:
+            await stop.wait()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Обработка запросов одного keep-alive соединения"""
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), timeout=75)
+                if not request_line:
+                    break
+
+                method, target = request_line.decode('latin-1').split(' ')[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > self.MAX_BODY:
+                    self._respond(writer, "413 Payload Too Large", keep_alive=False)
+                    break
+                body = await reader.readexactly(length)
+
+                status = self._process(method, target, headers, body)
+                self._respond(writer, status)
+                await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _process(self, method: str, target: str, headers: dict, body: bytes) -> str:
+        """Проверка запроса и передача обновления на обработку"""
+        if method != 'POST' or target.split('?')[0] != self.path:
+            return "404 Not Found"
+
+        token = headers.get('x-telegram-bot-api-secret-token', '').encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return "403 Forbidden"
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return "400 Bad Request"
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return "400 Bad Request"
+
+        self.received += 1
+        try:
+            self.dispatch(data)
+        except Exception as e:
+            # Повтор того же обновления Telegram не поможет - отвечаем 200
+            logger.error(f"Ошибка передачи обновления {data['update_id']}: {str(e)}")
+        return "200 OK"
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, status: str, keep_alive: bool = True) -> None:
+        connection = "keep-alive" if keep_alive else "close"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode())
+
+
+def update_chat_id(data: dict) -> int:
+    """chat_id из необработанного обновления Telegram (или id пользователя)"""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in data:
+            return data[key]['chat']['id']
+    if 'callback_query' in data:
+        query = data['callback_query']
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+def create_updater(bot: FairyTaleBot) -> Updater:
+    """Updater с зарегистрированными обработчиками и периодическими задачами"""
+    updater = Updater(os.getenv("TELEGRAM_BOT_TOKEN"), base_url=os.getenv("TELEGRAM_API_URL") or None)
+    dispatcher = updater.dispatcher
+
+    def timed(handler):
+        return bot.metrics.timed('dispatch', handler, handler=handler.__name__)
+
+    # Обработчики команд
+    dispatcher.add_handler(CommandHandler("start", timed(bot.start)))
+
+    # Повторные нажатия кнопок отсекаются до основных обработчиков
+    dispatcher.add_handler(CallbackQueryHandler(bot.debounce_callback), group=-1)
+
+    # Все нажатия кнопок - один обработчик с маршрутизацией по префиксу callback_data
+    dispatcher.add_handler(CallbackQueryHandler(timed(bot.handle_callback)))
+
+    # Обработчик текстовых сообщений
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, timed(bot.handle_message)))
+
+    # Периодический вывод метрик
+    stats_interval = int(os.getenv("STATS_INTERVAL", "60"))
+    if stats_interval > 0:
+        updater.job_queue.run_repeating(bot.log_stats, interval=stats_interval)
+    updater.job_queue.run_repeating(bot.expire_sessions, interval=600)
+    if bot.queue_notice_after > 0:
+        updater.job_queue.run_repeating(bot.notify_queues, interval=max(bot.queue_notice_after / 3, 1))
+
+    return updater
+
+
+def start_metrics(bot: FairyTaleBot, index: int = 0) -> None:
+    """Запуск сервера метрик, если задан порт (процессы-обработчики получают следующие порты)"""
+    port = int(os.getenv("METRICS_PORT", "0"))
+    if port and bot.metrics.enabled:
+        start_metrics_server(bot.metrics, os.getenv("METRICS_LISTEN", "127.0.0.1"), port + index)
+
+
+def start_dispatcher(updater: Updater) -> None:
+    """Запуск диспетчера и планировщика без long polling"""
+    threading.Thread(target=updater.dispatcher.start, name="dispatcher", daemon=True).start()
+    updater.job_queue.start()
+
+
+def stop_dispatcher(updater: Updater) -> None:
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+
+
+def webhook_worker(index: int, updates: multiprocessing.Queue) -> None:
+    """Процесс-обработчик: получает обновления своих чатов из очереди"""
+    # Остановкой управляет главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    bot = FairyTaleBot()
+    # У каждого процесса свой журнал незавершённых заданий
+    if bot.journal_path:
+        bot.journal_path += f".{index}"
+    updater = create_updater(bot)
+    start_metrics(bot, index + 1)
+    start_dispatcher(updater)
+    bot.resume_jobs(updater.bot)
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        updater.update_queue.put(Update.de_json(data, updater.bot))
+
+    stop_dispatcher(updater)
+    bot.shutdown()
+
+
+def run_polling() -> None:
+    """Запуск бота в режиме long polling"""
+    bot = FairyTaleBot()
+    updater = create_updater(bot)
+    start_metrics(bot)
+
+    updater.start_polling()
+    bot.resume_jobs(updater.bot)
+    logger.info("Бот запущен")
+    print("🤖 Бот запущен!")
+    updater.idle()
+    bot.shutdown()
+
+
+def run_webhook() -> None:
+    """Запуск бота в режиме вебхука
+
+    При WEBHOOK_WORKERS > 1 обновления распределяются по процессам
+    по chat_id, так что диалог всегда обрабатывается одним процессом.
+    """
+    url = os.getenv("WEBHOOK_URL")
+    secret = os.getenv("WEBHOOK_SECRET")
+    listen = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+    port = int(os.getenv("WEBHOOK_PORT", "8080"))
+    workers = int(os.getenv("WEBHOOK_WORKERS", "1"))
+
+    processes = []
+    if workers > 1:
+        context = multiprocessing.get_context('spawn')
+        queues = [context.Queue() for _ in range(workers)]
+        for i, updates in enumerate(queues):
+            process = context.Process(target=webhook_worker, args=(i, updates), name=f"bot-worker-{i}")
+            process.start()
+            processes.append(process)
+
+        def dispatch(data):
+            queues[update_chat_id(data) % workers].put(data)
+
+        Bot(os.getenv("TELEGRAM_BOT_TOKEN"), base_url=os.getenv("TELEGRAM_API_URL") or None).set_webhook(url=url, secret_token=secret)
+    else:
+        bot = FairyTaleBot()
+        updater = create_updater(bot)
+        start_metrics(bot)
+        start_dispatcher(updater)
+        bot.resume_jobs(updater.bot)
+
+        def dispatch(data):
+            updater.update_queue.put(Update.de_json(data, updater.bot))
+
+        updater.bot.set_webhook(url=url, secret_token=secret)
+
+    server = WebhookServer(urlparse(url).path or '/', secret, dispatch)
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await server.serve(listen, port, stop)
+
+    logger.info("Бот запущен (вебхук)")
+    print("🤖 Бот запущен!")
+    asyncio.run(serve())
+
+    if processes:
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()
+    else:
+        stop_dispatcher(updater)
+        bot.shutdown()
+
 
 def main():
     """Запуск бота"""
@@ -464,6 +3005,9 @@ def main():
         "YANDEX_SPEECH_API_KEY",
         "TELEGRAM_BOT_TOKEN"
     ]
+    mode = os.getenv("BOT_MODE", "polling")
+    if mode == "webhook":
+        required_vars += ["WEBHOOK_URL", "WEBHOOK_SECRET"]
 
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     if missing_vars:
@@ -471,31 +3015,10 @@ def main():
         print(f"❌ ОШИБКА: Не заданы: {', '.join(missing_vars)}")
         return
 
-    bot = FairyTaleBot()
-    updater = Updater(os.getenv("TELEGRAM_BOT_TOKEN"))
-    dispatcher = updater.dispatcher
-
-    # Обработчики команд
-    dispatcher.add_handler(CommandHandler("start", bot.start))
-
-    # Обработчики callback-запросов
-    dispatcher.add_handler(CallbackQueryHandler(bot.start_creation, pattern='^start_creation$'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_age, pattern='^age_'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_name, pattern='^skip_name$'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_family, pattern='^skip_family$'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_pets, pattern='^skip_pets$'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_interests, pattern='^skip_interests$'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_situation, pattern='^skip_situation$'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_request, pattern='^skip_request$'))
-    dispatcher.add_handler(CallbackQueryHandler(bot.process_voice_selection, pattern='^voice_'))
-
-    # Обработчик текстовых сообщений
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, bot.handle_message))
-
-    updater.start_polling()
-    logger.info("Бот запущен")
-    print("🤖 Бот запущен!")
-    updater.idle()
+    if mode == "webhook":
+        run_webhook()
+    else:
+        run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+import os
+import sys
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from skazki import CircuitBreaker, CircuitOpenError, YandexClient  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def close(self):
+        pass
+
+
+def make_client(outcomes, failure_threshold=1, reset_timeout=0):
+    """Клиент без повторов, отвечающий по очереди заданными статусами или исключениями"""
+    breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+    client = YandexClient("test", "http://127.0.0.1:9", {}, 1, 1, 1, 10, max_retries=0, breaker=breaker)
+
+    def send(timeout, kwargs):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return FakeResponse(outcome)
+
+    client._send_hedged = send
+    return client, breaker
+
+
+def test_breaker_stays_closed_below_threshold():
+    client, breaker = make_client([500, 200, 500], failure_threshold=2)
+    client.post()
+    client.post()
+    client.post()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_opens_and_closes_after_successful_probe():
+    client, breaker = make_client([500, 200])
+    assert client.post().status_code == 500
+    assert breaker.state == CircuitBreaker.OPEN
+    assert client.post().status_code == 200
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_breaker():
+    client, breaker = make_client([500, 503])
+    client.post()
+    client.post()
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_breaker_probe_with_429_does_not_stick_half_open():
+    client, breaker = make_client([500, 429, 200])
+    client.post()
+    assert client.post().status_code == 429
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert client.post().status_code == 200
+
+
+def test_breaker_probe_with_unexpected_error_reopens():
+    client, breaker = make_client([500, requests.exceptions.InvalidURL("bad"), 200])
+    client.post()
+    with pytest.raises(requests.exceptions.InvalidURL):
+        client.post()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert client.post().status_code == 200
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_expired_deadline_does_not_take_the_probe():
+    client, breaker = make_client([500, 200])
+    client.post()
+    with pytest.raises(requests.Timeout):
+        client.post(deadline=0)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert client.post().status_code == 200
+
+
+def test_open_breaker_rejects_without_request():
+    client, breaker = make_client([500], reset_timeout=60)
+    client.post()
+    with pytest.raises(CircuitOpenError):
+        client.post()
@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from skazki import ConversationState, MemorySessionStore, SqliteSessionStore  # noqa: E402
+
+
+def test_replaced_session_is_not_saved_over_new_one():
+    store = MemorySessionStore(ttl=3600)
+    old = store.create(1)
+    new = store.create(1)
+    old.state = ConversationState.VOICE_SELECTION
+    store.save(old)
+    assert store.get(1) is new
+
+
+def test_replaced_session_is_not_written_to_disk(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SqliteSessionStore(path, ttl=3600, flush_interval=60)
+    old = store.create(1)
+    old.fairy_tale = "прежняя сказка"
+    store.flush()
+    new = store.create(1)
+    new.answers = {'age': '5'}
+    old.state = ConversationState.VOICE_SELECTION
+    store.save(old)
+    store.close()
+
+    reopened = SqliteSessionStore(path, ttl=3600, flush_interval=60)
+    session = reopened.get(1)
+    reopened.close()
+    assert session.answers == {'age': '5'}
+    assert session.fairy_tale is None
+    assert session.state == ConversationState.START
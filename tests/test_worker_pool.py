@@ -0,0 +1,78 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from skazki import WorkerPool  # noqa: E402
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.005)
+
+
+def blocked_pool(size=1):
+    """Пул, все потоки которого заняты до release.set()"""
+    pool = WorkerPool("test", size)
+    release = threading.Event()
+    for i in range(size):
+        pool.submit(release.wait, chat_id=-1 - i)
+    wait_for(lambda: pool.stats()['in_flight'] == size)
+    return pool, release
+
+
+def test_priority_classes_run_in_order():
+    pool, release = blocked_pool()
+    order = []
+    for chat_id, priority in ((1, WorkerPool.REPEAT_TALE), (2, WorkerPool.BACKGROUND),
+                              (3, WorkerPool.FIRST_TALE), (4, WorkerPool.VOICE)):
+        pool.submit(order.append, chat_id, chat_id=chat_id, priority=priority)
+    release.set()
+    wait_for(lambda: len(order) == 4)
+    assert order == [3, 4, 1, 2]
+    pool.shutdown(1)
+
+
+def test_chats_take_turns_within_class():
+    pool, release = blocked_pool()
+    order = []
+    pool.submit(order.append, 'a1', chat_id=1)
+    pool.submit(order.append, 'a2', chat_id=1)
+    pool.submit(order.append, 'b1', chat_id=2)
+    release.set()
+    wait_for(lambda: len(order) == 3)
+    assert order == ['a1', 'b1', 'a2']
+    pool.shutdown(1)
+
+
+def test_one_job_per_chat_in_flight():
+    pool = WorkerPool("test", 2)
+    release = threading.Event()
+    started = []
+    pool.submit(lambda: (started.append('a1'), release.wait()), chat_id=1)
+    pool.submit(started.append, 'a2', chat_id=1)
+    pool.submit(started.append, 'b1', chat_id=2)
+    wait_for(lambda: 'b1' in started)
+    time.sleep(0.05)
+    # Второй поток свободен, но второе задание того же чата ждёт первого
+    assert 'a2' not in started
+    release.set()
+    wait_for(lambda: 'a2' in started)
+    pool.shutdown(1)
+
+
+def test_expired_job_is_shed():
+    pool, release = blocked_pool()
+    ran, shed = [], []
+    pool.submit(ran.append, 'late', chat_id=1, max_wait=0.01, on_shed=lambda: shed.append('late'))
+    pool.submit(ran.append, 'patient', chat_id=2, max_wait=60)
+    time.sleep(0.05)
+    release.set()
+    wait_for(lambda: ran == ['patient'])
+    assert shed == ['late']
+    assert pool.stats()['shed'] == 1
+    pool.shutdown(1)